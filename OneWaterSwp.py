@@ -14,6 +14,7 @@ sys.path.append('/Users/albertsmith/Documents/GitHub/')  # Path to SLEEPY folder
 import SLEEPY as sl
 sl.Defaults['verbose']=False
 sl.Defaults['parallel']=True #Maybe it makes sense to change this on the server?
+# sl.Defaults['cache_dir']='prop_cache'  #Keep step propagators on disk, so resubmitted jobs recycle them
 import os
 from time import time
 
@@ -42,40 +43,41 @@ nSD=11
 tc0=np.logspace(-6,-3,ntc)
 kSD0=np.logspace(0,2,nSD)
 
-counter=0
 folder='T1p_3spin_run0'
-
+v10=[2000,7000,12000,14000,22000]
 
 nt=500
-t0=time()
 
-for p,tc in enumerate(tc0):
-    for q,kSD in enumerate(kSD0):
-        file=os.path.join(folder,f'R1p_{-np.log10(tc):.1f}_{np.log10(kSD):.1f}').replace('.','p')+'.npy'
-        
-        if os.path.exists(file):continue #Already calculated
-        
-        I=np.zeros([5,nt])
-        
-        L=ex.Liouvillian()
-        L.add_SpinEx([1,2],tc)
-        
-        for i in range(1,3):
-            L.add_relax(Type='SpinDiffusion',i=i,k=kSD)
-            
-        
-        for k,v1 in enumerate([2000,7000,12000,14000,22000]):
-            try:
-                seq=L.Sequence().add_channel('13C',v1=v1)
+def setup(ex):
+    L=ex.Liouvillian()  #Built once; only the rates are updated for each point
+    L.add_SpinEx([1,2],tc0[0])
+    for i in range(1,3):
+        L.add_relax(Type='SpinDiffusion',i=i,k=kSD0[0])
+    return L
+
+def update(L,tc,kSD,v1):
+    L.set_rate(0,1/tc)
+    for i in range(1,3):
+        L.set_rate(i,kSD)
+
+def recipe(L,tc,kSD,v1):
+    try:
+        seq=L.Sequence().add_channel('13C',v1=v1)
         
-                rho=sl.Rho(rho0='13Cx',detect='13Cx')
-                rho.DetProp(seq,n=nt)
-                I[k]=rho.I[0].real
-            except:
-                print(file) 
-                
-        np.save(file,I,allow_pickle=False)
-        elapsed=(time()-t0)/60
-        counter+=1
-        total_time=elapsed*ntc*nSD/counter
-        print(f'{elapsed:.2f} minutes out of ~{total_time:.2f} minutes')
\ No newline at end of file
+        rho=sl.Rho(rho0='13Cx',detect='13Cx')
+        rho.DetProp(seq,n=nt)
+        return rho.I[0].real
+    except Exception as e:
+        print(tc,kSD,v1,e)
+        return None   #Not stored by the sweep (attempted again by the next run)
+
+def legacy(index,tc,kSD,v1):
+    #Older runs: one file per (tc,kSD), holding all spin-lock strengths (nv1,nt)
+    file=os.path.join(folder,f'R1p_{-np.log10(tc):.1f}_{np.log10(kSD):.1f}'.replace('.','p')+'.npy')
+    if os.path.exists(file):return np.load(file,allow_pickle=False)[index[2]]
+
+#Results (ntc,nSD,nv1,nt) are stored in folder/results.npy, with completed points in folder/done.npy
+sweep=sl.Sweep(ex,grid={'tc':tc0,'kSD':kSD0,'v1':v10},recipe=recipe,setup=setup,update=update,
+               folder=folder,legacy=legacy)
+if __name__=='__main__':
+    sweep.run()
@@ -204,8 +204,8 @@ class Hamiltonian():
                 H+=v0*Op.z 
         
         a,b=np.linalg.eigh(H)
-        U=RightSuper(b)@LeftSuper(b.T.conj())
-        Ui=RightSuper(b.T.conj())@LeftSuper(b)
+        U=(RightSuper(b,factored=True)@LeftSuper(b.T.conj(),factored=True)).dense()
+        Ui=(RightSuper(b.T.conj(),factored=True)@LeftSuper(b,factored=True)).dense()
         v=(np.tile(a,a.size)+np.repeat(a,a.size))/2
         return U,Ui,v
         
@@ -18,9 +18,10 @@ import numpy as np
 from copy import copy
 import warnings
 from scipy.linalg import expm
+import scipy.sparse as sps
 from .Propagator import Propagator,PropCache
 from . import Defaults
-from .Tools import Ham2Super,BlockDiagonal
+from .Tools import Ham2Super,BlockDiagonal,prod_tree,dense,phase_table
 from .Hamiltonian import Hamiltonian
 from . import RelaxMat
 from .RelaxClass import RelaxClass
@@ -75,11 +76,13 @@ class Liouvillian():
         self._Lex=None
         self._index=-1
         self._Lrelax=None
+        self._rates={}  #Relaxation matrix without terms modified by set_rate ('base'), and those terms (shared by indexed copies)
         self._Lrf=None
         self._Ln=None
-        # self._Ln_H=None
+        self._Ln_H={}  #Rotating components of the Hamiltonian part for each element of the powder average (shared by indexed copies)
         self._LrelaxOS=RelaxClass(self)
-        if Defaults['cache']:self._Ln_H=[[None for _ in range(5)] for _ in range(len(self))]
+        self._blocks={}  #Reduced Liouvillians (LiouvilleBlock), keyed by block
+        self._block_structure={}  #Results of Rho.Blocks, keyed by active channels, rho and detectors
         
         self._fields=self.fields
         
@@ -103,14 +106,26 @@ class Liouvillian():
         LiouvilleBlock 
 
         """
-        return LiouvilleBlock(self, block)
+        key=(self._index,np.asarray(block,dtype=bool).tobytes())
+        token=self._PropCache.token  #Changes if the Liouvillian is modified
+        out=self._blocks.get(key)
+        if out is None or out._token!=token:
+            out=LiouvilleBlock(self, block)
+            out._token=token
+            if Defaults['cache']:
+                for k in [k for k,v in self._blocks.items() if v._token!=token]:self._blocks.pop(k)
+                self._blocks[key]=out  #Reused, along with its stored propagators (counted against the shared Defaults['cache_bytes'])
+        return out
     
     @property
     def block(self):
         return np.ones(self.shape[0],dtype=bool)
     
     def clear_cache(self):
-        self._Ln_H=None
+        self._Ln_H.clear()
+        self._Ln=None
+        self._blocks.clear()
+        self._block_structure.clear()
         self._PropCache.reset()
         if self._LrelaxOS is not None:self.LrelaxOS.clear_cache()
         return self
@@ -128,6 +143,10 @@ class Liouvillian():
     def _ctype(self):
         return Defaults['ctype']
     
+    @property
+    def sparse(self):
+        return Defaults['sparse']
+    
     @property
     def _rtype(self):
         return Defaults['rtype']
@@ -253,7 +272,9 @@ class Liouvillian():
         
         if name=='kex':
             self._Lex=None
+            self._Ln=None
             self._PropCache.reset()
+            self._block_structure.clear()
             if value is not None:
                 value=np.array(value)
                 assert value.shape[0]==value.shape[1],"Exchange matrix must be square"
@@ -284,7 +305,6 @@ class Liouvillian():
         
         out.H=[H0[i] for H0 in self.H]
         out._Ln=None
-        out._Ln_H=None
         out._index=i
         out._PropCache=self._PropCache
         out._PropCache.L=out 
@@ -364,6 +384,7 @@ class Liouvillian():
 
         """
         self._PropCache.reset()
+        self._block_structure.clear()
         
         if isinstance(M,str): #In case Type is input as the first argument, just fix for the user
             Type=M
@@ -396,15 +417,87 @@ class Liouvillian():
                 warnings.warn(f'Unknown relaxation type: {Type}')
                 return self
         
+        self._add_Lrelax(M)
+        return self
+    
+    def _add_Lrelax(self,M,out=None):
+        """
+        Adds the matrix M to the relaxation matrix (or to out), either with the
+        full size of the Liouvillian or the size for just one Hamiltonian (in
+        which case M is added to each block)
+        """
         q=np.prod(self.H[0].shape)
-        self.Lrelax  #Call to make sure it's pre-allocated
+        if out is None:
+            if 'base' in self._rates:self._add_Lrelax(M,out=self._rates['base'])
+            out=self.Lrelax  #Call to make sure it's pre-allocated
         if M.shape[0]==self.shape[0]:
-            self._Lrelax+=M
+            out+=M
         elif M.shape[0]==q:
             for k,H0 in enumerate(self.H):
-                self._Lrelax[k*q:(k+1)*q][:,k*q:(k+1)*q]+=M
+                out[k*q:(k+1)*q][:,k*q:(k+1)*q]+=M
         else:
-            assert False,f"M needs to have size ({q},{q}) or {self.shape}"   
+            assert False,f"M needs to have size ({q},{q}) or {self.shape}"
+        self._Ln=None
+    
+    def set_rate(self,term_id:int,k:float):
+        """
+        Changes the rate constant of a relaxation term already added to the 
+        Liouvillian (via add_relax or add_SpinEx), without rebuilding the
+        Liouvillian. Only the relaxation matrix is updated, such that the 
+        coherent part of the Liouvillian is recycled. Stored propagators are
+        discarded. The relaxation matrix is re-summed from the remaining terms
+        and the current matrix of each modified term, such that the result 
+        does not depend on the history of rate changes.
+        
+        Supported types are T1, T2 (k=1/T1, 1/T2), SpinDiffusion (k), and
+        SpinExchange (k=1/tc). Orientation-specific terms are not supported.
+        Setting k=0 switches the term off (stored as T1, T2, or tc=inf), and
+        any subsequent non-zero k switches it back on.
+        
+        L=ex.Liouvillian()
+        L.add_SpinEx([1,2],tc=1e-5)
+        L.add_relax('SpinDiffusion',i=1,k=10)
+        for tc in tc0:
+            L.set_rate(0,1/tc)
+            ...
+
+        Parameters
+        ----------
+        term_id : int
+            Index of the term (index in L.relax_info)
+        k : float
+            New rate constant (s^-1).
+
+        Returns
+        -------
+        self
+
+        """
+        Type,kwargs=self.relax_info[term_id]
+        pars={'T1':'T1','T2':'T2','SpinDiffusion':'k','SpinExchange':'tc'}
+        assert Type in pars and not(kwargs.get('OS',False)),f"set_rate not available for {Type}{' (OS)' if kwargs.get('OS',False) else ''}"
+        assert 'recovery' not in [ri[0] for ri in self.relax_info],"set_rate cannot be used once recovery has been added"
+        
+        par=pars[Type]
+        kwargs1={**kwargs,par:k if par=='k' else (np.inf if k==0 else 1/k)}
+        if kwargs1[par]==kwargs[par]:return self
+        off=lambda kw:kw[par]==0 if par=='k' else np.isinf(kw[par])  #Term switched off (zero rate)
+        
+        self._PropCache.reset()
+        if not(np.all(np.isfinite([kwargs[par],kwargs1[par]])) and kwargs[par] and kwargs1[par]):
+            self._block_structure.clear()  #Terms switched on or off change the block structure
+        
+        rates=self._rates
+        if 'base' not in rates:rates['base']=self.Lrelax.copy()
+        if term_id not in rates and not(off(kwargs)):  #Remove the original term from the base matrix (once)
+            self._add_Lrelax(-getattr(RelaxMat,Type)(expsys=self.expsys,**kwargs),out=rates['base'])
+        rates[term_id]=None if off(kwargs1) else getattr(RelaxMat,Type)(expsys=self.expsys,**kwargs1)
+        
+        self._Lrelax[:]=rates['base']  #In-place: shared by indexed copies
+        for key,M in rates.items():
+            if key!='base' and M is not None:self._add_Lrelax(M,out=self._Lrelax)
+        self._Ln=None
+        self.relax_info[term_id]=(Type,kwargs1)
         return self
     
     def clear_relax(self):
@@ -420,6 +513,7 @@ class Liouvillian():
         
         self.relax_info=[]
         self._Lrelax=None
+        self._rates.clear()
         self._LrelaxOS.clear()
         if hasattr(self,'recovery'):
             delattr(self,'recovery')
@@ -494,7 +588,10 @@ class Liouvillian():
             if self.kex is None or self.kex.size!=len(self.H)**2 or self.kex.ndim!=2:
                 self.kex=np.zeros([len(self.H),len(self.H)],dtype=self._rtype)
                 if len(self.H)>1:print('Warning: Exchange matrix was not defined')
-            self._Lex=np.kron(self.kex.astype(self._rtype),np.eye(np.prod(self.H[0].shape),dtype=self._rtype))
+            if self.sparse:
+                self._Lex=sps.kron(self.kex.astype(self._rtype),sps.identity(np.prod(self.H[0].shape),dtype=self._rtype),format='csr')
+            else:
+                self._Lex=np.kron(self.kex.astype(self._rtype),np.eye(np.prod(self.H[0].shape),dtype=self._rtype))
             
         return self._Lex
     
@@ -519,24 +616,64 @@ class Liouvillian():
 
         """
         assert self.sub,"Calling Ln_H requires indexing to a specific element of the powder average"
-        # self._Ln_H=None
-        # if self._Ln_H is not None and self._Ln_H[self._index][n+2] is not None:
-        #     return copy(self._Ln_H[self._index][n+2])
-        
-        out=np.zeros(self.shape,dtype=self._ctype)
-        q=np.prod(self.H[0].shape)
-        for k,H0 in enumerate(self.H):
-            # TODO The next line should not be necessary. H0 should automatically be updated to its index
-            # Maybe somewhere we just changed the index instead of calling for the specific item
-            
-            H0=H0[H0._index] 
-            out[k*q:(k+1)*q][:,k*q:(k+1)*q]=H0.Ln(n)
-        out*=-1j*2*np.pi
         
+        return copy(self._Ln_H_all()[n+2])
+    
+    def _Ln_H_all(self):
+        """
+        Returns all rotating components of the Liouvillian resulting from the
+        Hamiltonians for the current element of the powder average, as a 
+        (5,d,d) array (list of sparse matrices in sparse mode). 
+        
+        Results are stored in _Ln_H, which is shared by all indexed copies of
+        the Liouvillian, such that repeated indexing does not rebuild the
+        Hamiltonian. The Hamiltonians themselves cannot be edited after 
+        initialization, so the stored components are discarded only if the
+        data type or sparse mode change, or clear_cache is called. Components
+        are only stored if they fit in Defaults['cache_bytes'] for the full
+        powder average (see _cache_Ln_H).
+
+        Returns
+        -------
+        np.array
+
+        """
+        key=(self._ctype,self.sparse)
+        if self._Ln_H.get('key')!=key:
+            self._Ln_H.clear()
+            self._Ln_H['key']=key
+        if self._index in self._Ln_H:return self._Ln_H[self._index]
+        
+        if self.sparse:
+            out=[(sps.block_diag([Ham2Super(H0[H0._index].Hn(n),sparse=True) for H0 in self.H],format='csr')\
+                  *(-1j*2*np.pi)).astype(self._ctype) for n in range(-2,3)]
+        else:
+            out=np.zeros([5,*self.shape],dtype=self._ctype)
+            q=np.prod(self.H[0].shape)
+            for k,H0 in enumerate(self.H):
+                # TODO The next line should not be necessary. H0 should automatically be updated to its index
+                # Maybe somewhere we just changed the index instead of calling for the specific item
+                
+                H0=H0[H0._index] 
+                for n in range(-2,3):
+                    out[n+2][k*q:(k+1)*q][:,k*q:(k+1)*q]=H0.Ln(n)
+            out*=-1j*2*np.pi
         
-        # if self._Ln_H is not None:self._Ln_H[self._index][n+2]=out
+        if self._cache_Ln_H:self._Ln_H[self._index]=out
         
-        return copy(out)
+        return out
+    
+    @property
+    def _cache_Ln_H(self):
+        """
+        True if the rotating components of the Hamiltonian for all elements of
+        the powder average fit in Defaults['cache_bytes'] (dense estimate, 
+        such that sparse storage is always within the budget). Note that this
+        is checked for each Liouvillian separately, and is not counted against
+        the budget shared by the propagator caches.
+        """
+        return Defaults['cache'] and \
+            5*np.prod(self.shape)*np.dtype(self._ctype).itemsize*len(self)<=Defaults['cache_bytes']
     
     def Ln(self,n:int):
         """
@@ -556,8 +693,12 @@ class Liouvillian():
         assert self.sub,"Calling Ln requires indexing to a specific element of the powder average"
         
         if self._Ln is None:
-            self._Ln=[self.Ln_H(n) for n in range(-2,3)]
-            self._Ln[2]+=self.Lex+self.Lrelax
+            if self.sparse:
+                self._Ln=[*self._Ln_H_all()]
+                self._Ln[2]=(self._Ln[2]+self.Lex+sps.csr_matrix(self.Lrelax)).tocsr()
+            else:
+                self._Ln=self._Ln_H_all().copy()  #Contiguous (5,d,d)
+                self._Ln[2]+=self.Lex+self.Lrelax
             
         return self._Ln[n+2]
     
@@ -576,6 +717,12 @@ class Liouvillian():
             self._Lrf=None
                 
         if self._Lrf is None:
+            if self.sparse:
+                Lrf0=Ham2Super(self.rf(),sparse=True)
+                self._Lrf=(sps.block_diag([Lrf0 for _ in self.H],format='csr')*(-1j*2*np.pi)).astype(self._ctype)
+                self._fields=copy(self.fields)
+                return self._Lrf
+            
             self._Lrf=np.zeros(self.shape,dtype=self._ctype)
             n=self.H[0].shape[0]**2
             Lrf0=Ham2Super(self.rf())
@@ -605,8 +752,13 @@ class Liouvillian():
         # ph=np.exp(1j*2*np.pi*step/n_gamma)
         # return np.sum([Ln0*ph**(-m) for Ln0,m in zip(Ln,range(-2,3))],axis=0)+self.Lrf
     
-        ph=np.exp(1j*2*np.pi*step/self.expsys.n_gamma)
-        return np.sum([self.Ln(m)*(ph**(-m)) for m in range(-2,3)],axis=0)+self.Lrf+self.LrelaxOS(step)    
+        ph=phase_table(self.expsys.n_gamma)[step%self.expsys.n_gamma]
+        if self.sparse:
+            out=sum([self.Ln(m)*ph[m+2] for m in range(-2,3)])+self.Lrf
+            if self.LrelaxOS.active:out+=sps.csr_matrix(self.LrelaxOS(step))
+            return out.tocsr()
+        self.Ln(0)
+        return np.tensordot(ph,self._Ln,axes=1)+self.Lrf+self.LrelaxOS(step)
     
     def Lcoh(self,step:int):
         """
@@ -627,8 +779,9 @@ class Liouvillian():
         # ph=np.exp(1j*2*np.pi*step/n_gamma)
         # return np.sum([Ln0*ph**(-m) for Ln0,m in zip(Ln,range(-2,3))],axis=0)+self.Lrf
     
-        ph=np.exp(1j*2*np.pi*step/self.expsys.n_gamma)
-        out=np.sum([self.Ln_H(m)*(ph**(-m)) for m in range(-2,3)],axis=0)   
+        ph=phase_table(self.expsys.n_gamma)[step%self.expsys.n_gamma]
+        if self.sparse:return sum([Ln0*ph0 for Ln0,ph0 in zip(self._Ln_H_all(),ph)]).tocsr()
+        out=np.tensordot(ph,self._Ln_H_all(),axes=1)
         return out
     
     def U(self,Dt:float=None,t0:float=None,calc_now:bool=False):
@@ -677,7 +830,7 @@ class Liouvillian():
         if calc_now:
             if self.sub:
                 if self.static:
-                    L=self.L(0)
+                    L=dense(self.L(0))
                     # U=expm(L*Dt)
     
                     d,v=np.linalg.eig(L)
@@ -701,23 +854,24 @@ class Liouvillian():
                     n0,nf,tm1,tp1=StepCalculator(t0=t0,Dt=Dt,dt=dt)
                     
                     if tm1==dt:
-                        U=self._PropCache[n0]
+                        U=[self._PropCache[n0]]
                     else:
-                        L=self.L(n0)
-                        U=expm(L*tm1)
+                        L=dense(self.L(n0))
+                        U=[expm(L*tm1)]
                         
                         
                     for n in range(n0+1,nf):
-                        U=self._PropCache[n]@U
+                        U.append(self._PropCache[n])
                         # L=self.L(n)
                         # U=expm(L*dt)@U
 
                     if tp1>1e-10:
                         if tp1==dt:
-                            U=self._PropCache[nf]@U
+                            U.append(self._PropCache[nf])
                         else:
-                            L=self.L(nf)
-                            U=expm(L*tp1)@U
+                            L=dense(self.L(nf))
+                            U.append(expm(L*tp1))
+                    U=prod_tree(U)  #Pairwise product of the step propagators
                     return Propagator(U,t0=t0,tf=tf,taur=self.taur,L=self,isotropic=self.isotropic,phase_accum=ph_acc)
             else:
                 if self.isotropic:
@@ -726,6 +880,7 @@ class Liouvillian():
                 else:
                     pm=ParallelManager(L=self,t0=t0,Dt=Dt)
                     U=pm()
+                    self._PropCache.save().trim()
                     return Propagator(U=U,t0=t0,tf=tf,taur=self.taur,L=self,isotropic=self.isotropic,phase_accum=ph_acc)
                 # if self._parallel and not(self.static):
                 #     dt=self.dt
@@ -779,7 +934,7 @@ class Liouvillian():
         else:
             if t0 is None:t0=self.expsys._tprop%self.taur
         
-        return Propagator(U=[np.eye(self.shape[0]) for _ in range(len(self))],
+        return Propagator(U=np.repeat([np.eye(self.shape[0])],len(self),axis=0),
                           t0=t0,tf=t0,taur=self.taur,L=self,isotropic=self.isotropic,phase_accum=0)    
     
     def Udelta(self,channel,phi:float=np.pi,phase:float=0,t0:float=None):
@@ -830,7 +985,7 @@ class Liouvillian():
             L[k*n:(k+1)*n][:,k*n:(k+1)*n]=L0
         U=expm(-1j*phi*L)
         
-        return Propagator(U=[U for _ in range(len(self))],
+        return Propagator(U=np.repeat([U],len(self),axis=0),
                           t0=t0,tf=t0,taur=self.taur,L=self,isotropic=self.isotropic,phase_accum=0)
 
     def Ueig(self):
@@ -1108,6 +1263,7 @@ class Liouvillian():
             x=getattr(self[len(self)//2] if self._index==-1 else self,what)
             if hasattr(x,'__call__'):
                 x=x(step)
+        x=dense(x)
                 
         if mode=='log' and np.max(np.abs(x[x!=0]))==np.min(np.abs(x[x!=0])):
             mode='abs'
@@ -1277,6 +1433,8 @@ class LiouvilleBlock(Liouvillian):
         self.__dict__=copy(L.__dict__)
         self._L=L
         self._block=block
+        self._blocks={}
+        self._block_structure={}
         self._PropCache=PropCache(self)
         self._LrelaxOS=RelaxClass(self)
         self.LrelaxOS.methods=L.LrelaxOS.methods
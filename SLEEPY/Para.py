@@ -9,8 +9,17 @@ Created on Wed Feb  7 11:10:03 2024
 import numpy as np
 from scipy.linalg import expm
 import multiprocessing as mp
+import atexit
+try:
+    from multiprocessing import resource_tracker
+    from multiprocessing.shared_memory import SharedMemory
+    SM=True
+except:
+    SM=False
 from . import Defaults
 from copy import copy
+from .Tools import expm_batch,prod_tree,dense,phase_table
+from itertools import groupby
 
 
 """
@@ -85,11 +94,16 @@ class ParallelManager():
             
     @property
     def Ln(self):
-        return [self.L.Ln(k) for k in range(-2,3)]
+        return np.array([dense(self.L.Ln(k)) for k in range(-2,3)])
     
     @property
     def parallel(self):
-        return Defaults['parallel'] if self.LrelaxOS is None else False
+        """
+        True if propagators are calculated on the worker processes. Sparse 
+        Liouvillians are always processed serially, since the workers would
+        receive dense copies of the Liouvillian.
+        """
+        return Defaults['parallel'] and not(self.L.sparse)
     
     
     @property
@@ -125,13 +139,32 @@ class ParallelManager():
     
     @property
     def setup(self):
+        return self.get_setup()
+    
+    def get_setup(self,shared:bool=False,k0:int=0):
+        """
+        Input tuples for calculating the propagator of each element of the 
+        powder average. If shared is True, Ln and Lrf are placed in shared memory, and only references
+        to them (SharedArray) are included. Orientation-specific relaxation 
+        is then also shared, but only for the chunk of the powder average 
+        starting at k0 that fits in Defaults['cache_bytes'] (see nchunk), such
+        that fewer than len(self) elements may be returned.
+        """
         if self.L.static:
-            return [(pm.L.L(0),*self.pars) for pm in self]
+            return [(dense(pm.L.L(0)),*self.pars) for pm in self]
         
-        if self.parallel or True:
-            out=[(pm.Ln,self.L.Lrf,pm.LrelaxOS,*self.pars,self.sm0,self.sm1,self.index,self.step_index,self.PropCache.SZ) for pm in self]
+        if shared:
+            Ln,Lrf=self.shared_Ln,self.shared_Lrf
+            R=None if self.LrelaxOS is None else self.shared_LrelaxOS(k0)
+            k1=len(self) if R is None else min(k0+self.nchunk,len(self))
+            out=[(Ln[k],Lrf,None if R is None else R[k-k0],*self.pars,self.sm0,self.sm1,
+                  self.index,self.step_index,self.PropCache.SZ) for k,pm in enumerate(self) if k0<=k<k1]
+        elif self.parallel or True:
+            Lrf=dense(self.L.Lrf)
+            out=[(pm.Ln,Lrf,pm.LrelaxOS,*self.pars,self.sm0,self.sm1,
+                  self.index,self.step_index,self.PropCache.SZ) for k,pm in enumerate(self)]
         else:
-            out=((pm.Ln,self.L.Lrf,pm.LrelaxOS,*self.pars,self.sm0,self.sm1,self.index,self.step_index,self.PropCache.SZ) for pm in self)
+            out=((pm.Ln,dense(self.L.Lrf),pm.LrelaxOS,*self.pars,self.sm0,self.sm1,self.index,self.step_index,self.PropCache.SZ) for pm in self)
         
         # TODO why is the next line necessary?
         # There's some failure to update reduced in LrelaxOS without it
@@ -140,6 +173,93 @@ class ParallelManager():
         return out
 
     
+    #%% Shared memory copies of the Liouvillian
+    @property
+    def shared_Ln(self):
+        """
+        Rotating components of the Liouvillian for all elements of the powder
+        average (N,5,d,d), stored in shared memory. Created once for the
+        current Liouvillian (and freed when its cache is reset).
+        """
+        smL=self.PropCache._smL
+        if 'Ln' not in smL:
+            SZ=(len(self),5,*self.L.shape)
+            sm=SharedMemory(create=True,size=int(np.prod(SZ))*np.dtype(Defaults['ctype']).itemsize)
+            Ln=np.ndarray(SZ,dtype=Defaults['ctype'],buffer=sm.buf)
+            for k,pm in enumerate(self):Ln[k]=pm.Ln
+            del Ln
+            smL['Ln']=(None,sm,SZ)
+        _,sm,SZ=smL['Ln']
+        return SharedArray(sm.name,SZ)
+    
+    @property
+    def shared_Lrf(self):
+        """
+        RF contribution to the Liouvillian, stored in shared memory. Replaced
+        when the applied fields change.
+        """
+        smL=self.PropCache._smL
+        field=self.PropCache.field
+        if 'Lrf' not in smL or smL['Lrf'][0]!=field:
+            if 'Lrf' in smL:smL.pop('Lrf')[1].unlink()
+            Lrf=dense(self.L.Lrf)
+            sm=SharedMemory(create=True,size=Lrf.nbytes)
+            np.ndarray(Lrf.shape,dtype=Lrf.dtype,buffer=sm.buf)[:]=Lrf
+            smL['Lrf']=(field,sm,Lrf.shape)
+        _,sm,SZ=smL['Lrf']
+        return SharedArray(sm.name,SZ)
+    
+    @property
+    def nchunk(self):
+        """
+        Number of elements of the powder average for which the orientation-
+        specific relaxation matrices (n_gamma,d,d) fit in Defaults['cache_bytes']
+        (checked separately, not counted against the budget shared by the
+        propagator caches)
+        """
+        nbytes=self.pars[-1]*np.prod(self.L.shape)*np.dtype(Defaults['ctype']).itemsize
+        return int(max(1,min(len(self),Defaults['cache_bytes']//nbytes)))
+    
+    def shared_LrelaxOS(self,k0:int=0):
+        """
+        Orientation-specific relaxation matrices for elements k0 to k0+nchunk
+        of the powder average and all steps of the rotor period 
+        (nchunk,n_gamma,d,d), stored in shared memory. If the full powder 
+        average fits in Defaults['cache_bytes'] (nchunk==len(self)), the 
+        matrices are kept between calls. Otherwise, the same memory is 
+        refilled for each chunk. Matrices are only calculated for steps 
+        required in the current call (i.e. not already found in the 
+        propagator cache).
+        """
+        smL=self.PropCache._smL
+        n0,nf,tm1,tp1,dt,n_gamma=self.pars
+        nchunk=self.nchunk
+        if 'LrelaxOS' in smL and smL['LrelaxOS'][2][0]!=nchunk:  #Budget changed
+            smL.pop('LrelaxOS')[1].unlink()
+        if 'LrelaxOS' not in smL:
+            SZ=(nchunk,n_gamma,*self.L.shape)
+            sm=SharedMemory(create=True,size=int(np.prod(SZ))*np.dtype(Defaults['ctype']).itemsize)
+            smL['LrelaxOS']=([k0,np.zeros(SZ[:2],dtype=bool)],sm,SZ)
+        state,sm,SZ=smL['LrelaxOS']
+        if state[0]!=k0:state[0],state[1][:]=k0,False  #New chunk of the powder average
+        done=state[1]
+        R=np.ndarray(SZ,dtype=Defaults['ctype'],buffer=sm.buf)
+        
+        st=[(n0,tm1),*[(n,dt) for n in range(n0+1,nf)]]
+        if tp1>1e-10:st.append((nf,tp1))
+        
+        ci=self.PropCache.calc_index if self.cache else None
+        for k,pm in enumerate(self):
+            if not(k0<=k<k0+nchunk):continue
+            index,step_index=self.index,self.step_index  #Depends on the current element
+            for n,t in st:
+                q=n%n_gamma
+                if done[k-k0,q] or (ci is not None and t==dt and ci[index[q],step_index[q]]):continue
+                R[k-k0,q]=pm.LrelaxOS(n)
+                done[k-k0,q]=True
+        del R
+        return SharedArray(sm.name,SZ)
+    
     @property
     def cpu_count(self):
         if isinstance(Defaults['ncores'],int):return Defaults['ncores']
@@ -151,69 +271,296 @@ class ParallelManager():
         else:
             fun=prop
         
+        if self.parallel:
+            pool=get_pool(self.cpu_count)
+            if fun is prop:
+                if SM and self.LrelaxOS is not None and self.nchunk<len(self):
+                    # Relaxation matrices for the full powder average do not fit in memory
+                    U=[]
+                    for k0 in range(0,len(self),self.nchunk):
+                        U.extend(pool(fun,self.get_setup(shared=True,k0=k0)))
+                    return U
+                U=pool(fun,self.get_setup(shared=SM))
+            else:
+                U=pool(fun,self.setup)
+            return U
+        
         X=self.setup
-        if Defaults['parallel']:
-            with mp.Pool(processes=self.cpu_count) as pool:
-                U=pool.map(fun,X)
-                
+        if fun is prop:
+            U=prop_batch(X)
         else:
             U=[fun(X0) for X0 in X]
         return U
     
 
+#%% Persistent worker processes
+class WorkerPool():
+    def __init__(self,nprocs:int):
+        """
+        Long-lived worker processes for calculating propagators. Workers stay
+        attached to the shared memory holding the Liouvillian (SharedArray) 
+        between calls, such that only references to it are sent.
+
+        Parameters
+        ----------
+        nprocs : int
+            Number of worker processes.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.nprocs=nprocs
+        self.conn=[]
+        self.procs=[]
+        if SM:resource_tracker.ensure_running()  #Workers should share the tracker for shared memory
+        for _ in range(nprocs):
+            conn0,conn1=mp.Pipe()
+            proc=mp.Process(target=worker,args=(conn1,),daemon=True)
+            proc.start()
+            self.conn.append(conn0)
+            self.procs.append(proc)
+    
+    @property
+    def alive(self):
+        return all([proc.is_alive() for proc in self.procs])
+    
+    def __call__(self,fun,X):
+        """
+        Evaluates fun for all elements of X on the worker processes. 
+
+        Parameters
+        ----------
+        fun : function
+            prop or prop_static
+        X : list
+            Setup from ParallelManager.
+
+        Returns
+        -------
+        list
+
+        """
+        for k,conn in enumerate(self.conn):
+            conn.send((fun,[(i,X[i]) for i in range(k,len(X),self.nprocs)]))
+        out=[None for _ in X]
+        error=None
+        for conn in self.conn:
+            success,result=conn.recv()
+            if success:
+                for i,U in result:out[i]=U
+            else:
+                error=result
+        if error is not None:
+            raise error
+        return out
+    
+    def close(self):
+        for conn,proc in zip(self.conn,self.procs):
+            try:
+                conn.send(None)
+            except:
+                pass
+            proc.join(timeout=1)
+            if proc.is_alive():proc.terminate()
+        self.conn,self.procs=[],[]
+        
+def worker(conn):
+    """
+    Main loop for the worker processes of WorkerPool
+    """
+    while True:
+        msg=conn.recv()
+        if msg is None:break
+        fun,X=msg
+        try:
+            if fun is prop:
+                names=set()
+                for _,X0 in X:names.update([x.name for x in X0[:3] if isinstance(x,SharedArray)])
+                SharedArray.release(keep=names)  #Detach from arrays no longer in use
+                X=[(i,tuple(x() if isinstance(x,SharedArray) else x for x in X0)) for i,X0 in X]
+                out=zip([i for i,_ in X],prop_batch([X0 for _,X0 in X]))
+            else:
+                out=[(i,fun(X0)) for i,X0 in X]
+            conn.send((True,list(out)))
+        except Exception as e:
+            conn.send((False,e))
+        X,out,msg=None,None,None
+    SharedArray.release()
+
+class SharedArray():
+    _attached={}  #Shared memory currently attached in this process
+    def __init__(self,name:str,shape:tuple,index:int=None):
+        """
+        Reference to an array in shared memory (or to one element of it along
+        the first dimension), sent to worker processes in place of the array.
+        Calling the object attaches to the shared memory (once per process)
+        and returns the array.
+
+        Parameters
+        ----------
+        name : str
+            Name of the shared memory.
+        shape : tuple
+            Shape of the full array.
+        index : int, optional
+            Element of the array. The default is None (full array).
+
+        Returns
+        -------
+        None.
+
+        """
+        self.name=name
+        self.shape=shape
+        self.index=index
+        
+    def __getitem__(self,i:int):
+        return SharedArray(self.name,self.shape,i)
+    
+    def __call__(self):
+        if self.name not in self._attached:
+            sm=SharedMemory(name=self.name)
+            self._attached[self.name]=(sm,np.ndarray(self.shape,dtype=Defaults['ctype'],buffer=sm.buf))
+        A=self._attached[self.name][1]
+        return A if self.index is None else A[self.index]
+    
+    @classmethod
+    def release(cls,keep:set=set()):
+        """
+        Detaches from shared memory, except for names found in keep
+        """
+        for name in [name for name in cls._attached if name not in keep]:
+            sm,A=cls._attached.pop(name)
+            del A
+            try:
+                sm.close()
+            except BufferError:
+                pass
+
+_pool=None
+def get_pool(nprocs:int):
+    """
+    Returns the persistent worker pool, starting it if not running (or if the
+    number of processes has changed)
+    """
+    global _pool
+    if _pool is not None and (_pool.nprocs!=nprocs or not(_pool.alive)):
+        close_pool()
+    if _pool is None:
+        _pool=WorkerPool(nprocs)
+    return _pool
+
+def close_pool():
+    """
+    Stops the persistent worker pool
+    """
+    global _pool
+    if _pool is not None:_pool.close()
+    _pool=None
+
+atexit.register(close_pool)
+
 #%% Parallel functions
 def prop(X):
-    Ln0,Lrf,LrelaxOS,n0,nf,tm1,tp1,dt,n_gamma,sm0,sm1,index,step_index,SZ=X
-    
-    if LrelaxOS is None:LrelaxOS=lambda n:0
-    
-    # Setup if using the shared cache
-    if sm0 is None:
-        ci=None
-    elif hasattr(sm0,'buf'):
-        ci=np.ndarray(SZ[:2],dtype=bool,buffer=sm0.buf)
-        Ucache=np.ndarray(SZ,dtype=Defaults['ctype'],buffer=sm1.buf)
-    else:
-        ci=sm0
-        Ucache=sm1
-        
-    #Initial propagator
-    # count0,count1=0,0
-    if ci is not None and tm1==dt and ci[index[n0%n_gamma],step_index[n0%n_gamma]]:
-        U=Ucache[index[n0%n_gamma],step_index[n0%n_gamma]]
-        # count0+=1
-    else:
-        ph=np.exp(1j*2*np.pi*n0/n_gamma)
-        L=np.sum([Ln0[m+2]*(ph**(-m)) for m in range(-2,3)],axis=0)+Lrf+LrelaxOS(n0)
-        U=expm(L*tm1)
-        if tm1==dt and ci is not None:
-            # count1+=1
-            Ucache[index[n0%n_gamma],step_index[n0%n_gamma]]=U
-            ci[index[n0%n_gamma],step_index[n0%n_gamma]]=True
-
-    for n in range(n0+1,nf):
-        i,si=index[n%n_gamma],step_index[n%n_gamma]
-        if ci is None or not(ci[i,si]): #Not cached
-            ph=np.exp(1j*2*np.pi*n/n_gamma)
-            L=np.sum([Ln0[m+2]*(ph**(-m)) for m in range(-2,3)],axis=0)+Lrf+LrelaxOS(n)
-            U0=expm(L*dt)
-            if ci is not None:
-                # count1+=1
-                Ucache[i,si]=U0
-                ci[i,si]=True
+    return prop_batch([X])[0]
+
+def prop_batch(X):
+    """
+    Calculates propagators for a list of elements of the powder average (each
+    element of X is the tuple produced by ParallelManager.setup). Step 
+    propagators not already found in the cache are collected over all steps
+    and all elements of the powder average, and exponentiated together in 
+    stacks (Tools.expm_batch). The size of each stack is set by 
+    Defaults['batch_bytes']. After each stack, the step propagators of each
+    element are combined into a partial product, such that memory use does not
+    grow with the number of steps.
+
+    Parameters
+    ----------
+    X : list
+        List of tuples from ParallelManager.setup.
+
+    Returns
+    -------
+    list
+        Propagator matrix for each element of X
+
+    """
+    
+    U=[None for _ in X]     #Partial product of the step propagators for each element
+    steps=[[] for _ in X]   #Step propagators not yet in U (cache index or job index)
+    jobs=[]     #Step propagators to be calculated (element, step, time, cache index)
+    pending={}  #Cache indices already scheduled for calculation
+    results={}  #Calculated, uncached step propagators
+    
+    def flush():
+        nonlocal jobs
+        if len(jobs):
+            L=[]
+            for k,grp in groupby(jobs,key=lambda job:job[0]):  #One contraction per element of the powder average
+                grp=list(grp)
+                L.append(Lstep(X[k],[job[1] for job in grp])*np.array([job[2] for job in grp])[:,None,None])
+            L=np.concatenate(L)
+            for (k,n,t,key),U0 in zip(jobs,expm_batch(L)):
+                if key is None:
+                    results[(k,n,t)]=U0
+                else:
+                    Ucache[key]=U0
+                    ci[key]=True
+                    pending.pop(key)
+            jobs=[]
+        for k,st in enumerate(steps):  #All scheduled steps are now available: chain onto the partial products
+            if not(len(st)):continue
+            st=[Ucache[x] if len(x)==2 else results.pop(x) for x in st]
+            U[k]=prod_tree(st if U[k] is None else [U[k],*st])
+            steps[k]=[]
+    
+    ci,Ucache=None,None
+    for k,X0 in enumerate(X):
+        Ln0,Lrf,LrelaxOS,n0,nf,tm1,tp1,dt,n_gamma,sm0,sm1,index,step_index,SZ=X0
+        
+        # Setup if using the shared cache
+        if sm0 is None:
+            ci=None
+        elif hasattr(sm0,'buf'):
+            ci=np.ndarray(SZ[:2],dtype=bool,buffer=sm0.buf)
+            Ucache=np.ndarray(SZ,dtype=Defaults['ctype'],buffer=sm1.buf)
         else:
-            # count0+=1
-            U0=Ucache[i,si]
-        U=U0@U
-    # print(count0,count1)
-            
-    if tp1>1e-10: #Last propagator
-        ph=np.exp(1j*2*np.pi*nf/n_gamma)
-        L=np.sum([Ln0[m+2]*(ph**(-m)) for m in range(-2,3)],axis=0)+Lrf+LrelaxOS(nf)
-        U=expm(L*tp1)@U
+            ci=sm0
+            Ucache=sm1
+        
+        nbatch=max(1,Defaults['batch_bytes']//(Ln0[0].nbytes))
+        
+        st=[(n0,tm1),*[(n,dt) for n in range(n0+1,nf)]]
+        if tp1>1e-10:st.append((nf,tp1))  #Last propagator
+        
+        for n,t in st:
+            key=(index[n%n_gamma],step_index[n%n_gamma]) if (ci is not None and t==dt) else None
+            if key is None or not(ci[key]):
+                if key is None or key not in pending:
+                    jobs.append((k,n,t,key))
+                    if key is not None:pending[key]=True
+            steps[k].append((k,n,t) if key is None else key)
+            if len(jobs)>=nbatch:flush()
+    flush()
     
     return U
 
+def Lstep(X,n):
+    """
+    Liouvillians for steps n (list) of the rotor period for the element of the
+    powder average described by X (from ParallelManager.setup). Obtained by
+    contraction of the rotating components (5,d,d) with the phase table.
+    """
+    Ln0,Lrf,LrelaxOS,n_gamma=X[0],X[1],X[2],X[8]
+    n=np.array(n)
+    L=np.tensordot(phase_table(n_gamma)[n%n_gamma],Ln0,axes=1)+Lrf
+    if LrelaxOS is not None:  #RelaxClass or precomputed matrices for each step (n_gamma,d,d)
+        for L0,n0 in zip(L,n):L0+=LrelaxOS(n0) if callable(LrelaxOS) else LrelaxOS[n0%n_gamma]
+    return L
+
 def prop_static(X):
     L,Dt=X
     return expm(L*Dt)
@@ -9,6 +9,7 @@ Created on Thu Jan 26 09:16:50 2023
 
 import numpy as np
 from scipy.linalg import expm
+from .Tools import phase_table
 
 import multiprocessing as mp
 
@@ -88,17 +89,12 @@ def prop_static(L,Dt):
 def prop0(X):
     Ln0,Lrf,n0,nf,tm1,tp1,dt,n_gamma=X
     
-    ph=np.exp(1j*2*np.pi*n0/n_gamma)
-    L=np.sum([Ln0[m+2]*(ph**(-m)) for m in range(-2,3)],axis=0)+Lrf
-    U=expm(L*tm1)
-    for n in range(n0+1,nf):
-        ph=np.exp(1j*2*np.pi*n/n_gamma)
-        L=np.sum([Ln0[m+2]*(ph**(-m)) for m in range(-2,3)],axis=0)+Lrf
-        U=expm(L*dt)@U
+    L=np.tensordot(phase_table(n_gamma)[np.arange(n0,nf+1)%n_gamma],np.array(Ln0),axes=1)+Lrf  #All steps at once
+    U=expm(L[0]*tm1)
+    for L0 in L[1:-1]:
+        U=expm(L0*dt)@U
     if tp1>1e-10:
-        ph=np.exp(1j*2*np.pi*nf/n_gamma)
-        L=np.sum([Ln0[m+2]*(ph**(-m)) for m in range(-2,3)],axis=0)+Lrf
-        U=expm(L*dt)@U
+        U=expm(L[-1]*dt)@U
     
     return U
 
@@ -130,8 +126,8 @@ def prop_x_rho0(X):
             # HERE WE NEED TO GO THROUGH THE ROTOR CYCLE, EX. SEE LIOUVILLIAN,
             # LINES 487-
         
-from copy import copy
-def expm_x_rho(Ldt,rho,n=20):
+from scipy.sparse.linalg import expm_multiply
+def expm_x_rho(Ldt,rho):
     """
     Calculates the product of the matrix exponential multiplied by the density
     operator. Bypasses full calculation of the matrix exponential
@@ -145,15 +141,11 @@ def expm_x_rho(Ldt,rho,n=20):
 
     Returns
     -------
-    None.
+    np.array
 
     """
     
-    out=copy(rho)
-    for k in range(1,n):
-        rho=Ldt@rho
-        out+=rho/np.math.factorial(k)
-    return out
+    return expm_multiply(Ldt,rho)
             
     
             
@@ -9,16 +9,21 @@ Created on Tue Jan 17 21:29:29 2023
 import numpy as np
 from fractions import Fraction
 import warnings
+import os
+from hashlib import sha1
 from copy import copy
+from itertools import count
+from weakref import WeakSet
 from scipy.linalg import expm
 from . import Defaults
+from .Tools import dense,inv_batch
 
 tol=1e-10
 
 class Propagator():
     def __init__(self,U,t0,tf,taur,L,isotropic,phase_accum):
+        self.pwdavg=not(hasattr(U,'ndim') and U.ndim==2)
         self.U=U
-        self.pwdavg=False if hasattr(U,'shape') else True
         self.t0=t0
         self.tf=tf
         self.taur=taur
@@ -29,6 +34,22 @@ class Propagator():
         self.phase_accum=phase_accum%(2*np.pi)
         
     
+    @property
+    def U(self):
+        """
+        Propagator matrices, stacked over the powder average (N,d,d), or a
+        single matrix (d,d) if the propagator does not have a powder average.
+        Before calculation, a dictionary with the sequence information (t,
+        v1, phase, voff).
+        """
+        return self._U
+    
+    @U.setter
+    def U(self,U):
+        if isinstance(U,(list,tuple)):
+            U=np.array([dense(U0) for U0 in U])
+        self._U=U
+    
     @property
     def calculated(self):
         if isinstance(self.U,dict):return False
@@ -79,17 +100,18 @@ class Propagator():
         """
         out=copy(self)
         out.L=self.L.getBlock(block)
+        out._eig=None
         if self.calculated:
-            for k,U in enumerate(self.U):
-                out.U[k]=U[block][:,block]
+            out.U=self.U[...,block,:][...,block]
                 
         return out
             
     def eig(self,back_calc:bool=True):
         """
         Calculates eigenvalues/eigenvectors of all stored propagators. Stored for
-        later usage (self._eig). Subsequent operations will be performed in
-        the eigenbasis where possible. Note that we will also ensure that no
+        later usage (self._eig), along with the (pseudo-)inverse of the 
+        eigenvectors, as (d,v,vi) for each element of the powder average. 
+        Subsequent operations will be performed in the eigenbasis where possible. Note that we will also ensure that no
         eigenvalues have an absolute value greater than 1. For systems that 
         deviate due to numerical error, this approach may stabilize the system.
 
@@ -106,63 +128,63 @@ class Propagator():
 
         """
         if self._eig is None:
-            self._eig=list()
-            Unew=list()
-            for k,U in enumerate(self):
-                d,v=np.linalg.eig(U)
-                # We do this because anything above 1 would be producing magnetization
-                # The most we can have is 1, which represents equilibrium
-                # under the current conditions
+            self.calcU()
+            U=self.U if self.pwdavg else self.U[None]   #Stacked (N,d,d): one batched decomposition for the powder average
+            d,v=np.linalg.eig(U)
+            # We do this because anything above 1 would be producing magnetization
+            # The most we can have is 1, which represents equilibrium
+            # under the current conditions
+            
+            # Is this correct, though? Does DNP produce magnetization? At
+            # the moment, Solid Effect works. So probably ok.
+            
+            dabs=np.abs(d) 
+            i=dabs>1
+            d[i]/=dabs[i]
+            if self.L.Peq and not self.reduced:
+                # This approach is not valid for some reduced matrices....
+                
+                # We do this because there does indeed need to be an equilibrium
+                # state. It is possible, however, that without relaxation,
+                # the equilibrium state is never accessed. Still, it
+                # doesn't hurt to enforce it's existence. Note that we're
+                # just cleaning up numerical error that might have the
+                # equilibrium deviate slightly from 1, leading to slow
+                # decay of all magnetization. It won't increase only because
+                # we already cleaned that up several lines above.
+                #
+                # Actually....it's totally wrong to do this. Ignore the above
+                # I'm leaving my comments in case I remember why
+                # I thought this was a good idea...oops
+                #
+                # And now I don't know why I thought it was wrong...I think
+                # I'm mixing up what the Liouvillian and the propagator
+                # should do.
+                
+                # And a final comment: I think it's always ok for the full
+                # matrix to set one state to have an eigenvalue of 1, 
+                # representing the equilibrium position of the density
+                # matrix. This is analogous to the null-space of the 
+                # Liouvillian (which, btw, if only coherent, then has
+                # a larger null-space, but once relaxation/dynamics come
+                # in, then the null-space seems to reduce to 1 element)
                 
-                # Is this correct, though? Does DNP produce magnetization? At
-                # the moment, Solid Effect works. So probably ok.
+                # However, it is not correct under irradiation to force
+                # the corresponding eigenvector to be equal to the equilibrium
+                # density operator. In particular, it destroys DNP
+                # transfers.
                 
-                dabs=np.abs(d) 
-                i=dabs>1
-                d[i]/=dabs[i]
-                if self.L.Peq and not self.reduced:
-                    # This approach is not valid for some reduced matrices....
-                    
-                    # We do this because there does indeed need to be an equilibrium
-                    # state. It is possible, however, that without relaxation,
-                    # the equilibrium state is never accessed. Still, it
-                    # doesn't hurt to enforce it's existence. Note that we're
-                    # just cleaning up numerical error that might have the
-                    # equilibrium deviate slightly from 1, leading to slow
-                    # decay of all magnetization. It won't increase only because
-                    # we already cleaned that up several lines above.
-                    #
-                    # Actually....it's totally wrong to do this. Ignore the above
-                    # I'm leaving my comments in case I remember why
-                    # I thought this was a good idea...oops
-                    #
-                    # And now I don't know why I thought it was wrong...I think
-                    # I'm mixing up what the Liouvillian and the propagator
-                    # should do.
-                    
-                    # And a final comment: I think it's always ok for the full
-                    # matrix to set one state to have an eigenvalue of 1, 
-                    # representing the equilibrium position of the density
-                    # matrix. This is analogous to the null-space of the 
-                    # Liouvillian (which, btw, if only coherent, then has
-                    # a larger null-space, but once relaxation/dynamics come
-                    # in, then the null-space seems to reduce to 1 element)
-                    
-                    # However, it is not correct under irradiation to force
-                    # the corresponding eigenvector to be equal to the equilibrium
-                    # density operator. In particular, it destroys DNP
-                    # transfers.
-                    
-                    i=np.argmax(d.real)
-                    
-                    # The
-                    # v[:,i]=self.L.rho_eq(pwdindex=k)
-                    # v[:,i]/=np.sqrt((v[:,i].conj()*v[:,i]).sum())
-                    d[i]=1.
-                self._eig.append((d,v))
-                if back_calc:
-                    Unew.append(v@np.diag(d)@np.linalg.pinv(v))
-            if back_calc:self.U=Unew
+                i=np.argmax(d.real,axis=-1)
+                
+                # The
+                # v[:,i]=self.L.rho_eq(pwdindex=k)
+                # v[:,i]/=np.sqrt((v[:,i].conj()*v[:,i]).sum())
+                d[np.arange(d.shape[0]),i]=1.
+            vi=inv_batch(v)    #Calculated once, reused by __pow__ and Rho.DetProp
+            self._eig=list(zip(d,v,vi))
+            if back_calc:
+                Unew=(v*d[:,None,:])@vi  #v@diag(d)@vi for all elements
+                self.U=Unew if self.pwdavg else Unew[0]
         return self
         
     
@@ -243,12 +265,10 @@ class Propagator():
         else:
             assert not(U.pwdavg),"Both propagators should have a powder average or both not"
 
-        if U is self:
-            Uout=[U1@U1 for U1 in self]
-        else:
-            Uout=[U1@U2 for U1,U2 in zip(self,U)]
+        self.calcU()
+        U.calcU()
+        Uout=self.U@U.U  #Batched over the powder average
         
-        if not(self.pwdavg):Uout=Uout[0]
         return Propagator(Uout,t0=U.t0,tf=U.tf+self.Dt,taur=self.taur,L=self.L,isotropic=self.isotropic,phase_accum=self.phase_accum+U.phase_accum)
     
     # def __rmul__(self,U):
@@ -289,12 +309,10 @@ class Propagator():
     
         self.eig()
 
-        Uout=list()
-        _eig=list()
-        for d,v in self._eig:
-            D=d**n
-            Uout.append(v@np.diag(D)@np.linalg.pinv(v))
-            _eig.append((D,v))
+        d,v,vi=[np.array(x) for x in zip(*self._eig)]   #Stacked over the powder average
+        D=d**n
+        Uout=(v*D[:,None,:])@vi
+        _eig=list(zip(D,v,vi))
         
         # for U in self:
         #     d,v=np.linalg.eig(U)
@@ -354,6 +372,10 @@ class Propagator():
                 
     
 
+_tokens=count()
+_stamps=count()  #Global order of use of the stored fields (see PropCache.trim)
+_caches=WeakSet()  #All propagator caches, which share Defaults['cache_bytes']
+
 try:
     from multiprocessing.shared_memory import SharedMemory
     SM=True
@@ -383,19 +405,26 @@ class PropCache():
         self.L=L
         self._sm0=[]
         self._sm1=[]
+        self._smL={}
         self.reset()
+        _caches.add(self)
         
         
     def reset(self):
         self.fields=[]
         self._U=[]
         self._calc_index=[]
+        self._disk=[]
         for sm in [*self._sm0,*self._sm1]:
             if sm is None:continue
             sm.unlink()
         self._sm0=[]
         self._sm1=[]
+        for _,sm,_ in self._smL.values():sm.unlink()
+        self._smL={}  #Shared copies of Ln/Lrf for worker processes
+        self._used={}  #Fields, with the stamp of their most recent use
         self.cache=Defaults['cache']
+        self.token=next(_tokens)  #Identifies the current Liouvillian (see Liouvillian.getBlock)
         return self
         
         
@@ -411,9 +440,11 @@ class PropCache():
     
     @property
     def field_index(self):
-        if self.field not in self.fields:
+        field=self.field
+        if field not in self.fields:
             self.add_field()
-        return self.fields.index(self.field)
+        if field in self._used:self._used[field]=next(_stamps)
+        return self.fields.index(field)
     
     @property
     def U(self):
@@ -449,8 +480,27 @@ class PropCache():
     
     @property
     def nbytes(self):
-        nb=np.zeros(1,dtype=Defaults['ctype']).nbytes
-        return np.prod(self.SZ)*nb
+        """
+        Memory currently used for storing propagators (all fields). For 
+        propagators stored on disk, only calculated propagators are counted.
+        """
+        return sum(self._nbytes(i) for i in range(len(self.fields)))
+    
+    def _nbytes(self,i:int):
+        """
+        Memory used for storing propagators of the ith field
+        """
+        U,ci,disk=self._U[i],self._calc_index[i],self._disk[i]
+        if disk is not None and U is disk[1]:
+            return int(ci.sum()*U[0,0].nbytes)
+        return int(U.nbytes)
+    
+    @property
+    def field_nbytes(self):
+        """
+        Size of the full propagator storage for a single field
+        """
+        return int(np.prod(self.SZ))*np.dtype(Defaults['ctype']).itemsize
         
     #%% Sizes/indices
     @property
@@ -471,21 +521,165 @@ class PropCache():
     def add_field(self):
         if not(self.cache):return
         if self.field not in self.fields:
+            shared=Defaults['parallel'] and not(self.L.sparse) and self.shared_memory  #Sparse: serial (see ParallelManager.parallel)
+            self.trim(self.field_nbytes if shared else 0)
             self.fields.append(self.field)
-            if Defaults['parallel'] and self.shared_memory:
+            self._used[self.field]=next(_stamps)
+            disk=self.open_disk()
+            if shared:
                 self.sm0=SharedMemory(create=True,size=np.prod(self.SZ[:2]))
-                self.sm1=SharedMemory(create=True,size=self.nbytes)
+                self.sm1=SharedMemory(create=True,size=self.field_nbytes)
                 self.calc_index=np.ndarray(shape=self.SZ[:2],dtype=bool,buffer=self.sm0.buf)
                 self.U=np.ndarray(shape=self.SZ,dtype=Defaults['ctype'],buffer=self.sm1.buf)
+                if disk is None:
+                    self._calc_index[-1][:]=False
+                else:
+                    self._calc_index[-1][:]=disk[0]
+                    self._U[-1][disk[0]]=disk[1][disk[0]]
+            elif disk is not None:
+                self.sm0=None
+                self.sm1=None
+                self.calc_index,self.U=disk  #Work directly on the memory-mapped files
             else:
                 self.sm0=None
                 self.sm1=None
                 self.calc_index=np.zeros(self.SZ[:2],dtype=bool)
-                self.U=np.zeros(self.SZ,dtype=Defaults['ctype'])          
+                self.U=LazyArray(self.SZ,dtype=Defaults['ctype'])
+            self._disk.append(disk)
+        return self
+    
+    def trim(self,nbytes:int=0):
+        """
+        Removes the least recently used fields until the stored propagators,
+        plus nbytes to be added, fit in Defaults['cache_bytes']. The budget is
+        shared by all propagator caches (all Liouvillians and their blocks),
+        so fields stored by other caches may be removed. The field currently
+        in use by this cache is never removed.
+
+        Parameters
+        ----------
+        nbytes : int, optional
+            Memory about to be allocated. The default is 0.
+
+        Returns
+        -------
+        self
+
+        """
+        if Defaults['cache_bytes'] is None:return self
+        total=sum(PC.nbytes for PC in _caches)+nbytes
+        if total<=Defaults['cache_bytes']:return self
+        
+        field0=self.field
+        for _,PC,field in sorted([(stamp,PC,field) for PC in _caches for field,stamp in PC._used.items()],
+                                 key=lambda x:x[0]):
+            if total<=Defaults['cache_bytes']:break
+            if PC is self and field==field0:continue
+            total-=PC._nbytes(PC.fields.index(field))
+            PC.remove_field(field)
+        return self
+    
+    def remove_field(self,field):
+        """
+        Deletes the stored propagators for a given field (tuple of fields as 
+        found in self.fields)
+        """
+        i=self.fields.index(field)
+        self.save(i)
+        for sm in [self._sm0[i],self._sm1[i]]:
+            if sm is not None:sm.unlink()
+        for x in [self.fields,self._U,self._calc_index,self._sm0,self._sm1,self._disk]:
+            x.pop(i)
+        self._used.pop(field)
+        return self
+    
+    #%% Disk storage
+    @property
+    def key(self):
+        """
+        Content hash of the step propagators for the current field. Obtained
+        from the rotating components of the Hamiltonians for all elements of 
+        the powder average, the exchange, relaxation, and rf contributions to
+        the Liouvillian, and the timestep.
+
+        Returns
+        -------
+        str
+
+        """
+        L=self.L
+        h=sha1()
+        for H in L.H:
+            for i in range(len(H)):
+                H0=H[i]
+                for n in range(-2,3):h.update(np.ascontiguousarray(H0.Hn(n)).tobytes())
+        for x in [L.Lex,L.Lrelax,L.Lrf,L.block]:
+            h.update(np.ascontiguousarray(dense(x)).tobytes())
+        h.update(repr((L.relax_info,L.expsys.T_K,L.dt,self.SZ,self.pwdavg.n_gamma,
+                       np.dtype(Defaults['ctype']).str)).encode())
+        return h.hexdigest()
+    
+    def open_disk(self):
+        """
+        Opens (or creates) the memory-mapped files storing the propagators for 
+        the current field in Defaults['cache_dir']. Files are named by the
+        content hash of the Liouvillian (see PropCache.key), such that
+        propagators are recycled between runs of the same system.
+        
+        Returns None if Defaults['cache_dir'] is None
+
+        Returns
+        -------
+        tuple
+            (calc_index,U)
+
+        """
+        if Defaults['cache_dir'] is None:return
+        
+        os.makedirs(Defaults['cache_dir'],exist_ok=True)
+        filename=os.path.join(Defaults['cache_dir'],self.key)
+        SZ=tuple(int(x) for x in self.SZ)
+        out=[]
+        for ext,shape,dtype in [('_calc.npy',SZ[:2],bool),('_U.npy',SZ,Defaults['ctype'])]:
+            if not(os.path.exists(filename+ext)):
+                tmp=filename+f'{ext}.{os.getpid()}.tmp'  #Create under temporary name, then move into place
+                np.lib.format.open_memmap(tmp,mode='w+',dtype=dtype,shape=shape).flush()
+                os.replace(tmp,filename+ext)
+            out.append(np.lib.format.open_memmap(filename+ext,mode='r+'))
+            assert out[-1].shape==shape and out[-1].dtype==dtype,f'Cached file {filename+ext} does not match the current system'
+        return tuple(out)
+    
+    def save(self,i:int=None):
+        """
+        Writes propagators calculated for the current field to disk (only if
+        Defaults['cache_dir'] is set). Propagators are written before their
+        index, such that an interrupted save does not leave invalid entries.
+        
+        Parameters
+        ----------
+        i : int, optional
+            Index of the field to save. The default is None (current field)
+
+        Returns
+        -------
+        self
+
+        """
+        if not(self.cache) or not(self.fields):return self
+        if i is None:i=self.field_index
+        if self._disk[i] is None:return self
+        ci,U=self._disk[i]
+        calc_index=self._calc_index[i]
+        if U is not self._U[i]:
+            index=np.logical_and(calc_index,np.logical_not(ci))
+            U[index]=self._U[i][index]
+        U.flush()
+        ci[:]=np.logical_or(ci,calc_index)
+        ci.flush()
         return self
     
     def __del__(self,*args):
-        for sm in [*self._sm0,*self._sm1]:
+        for sm in [*self._sm0,*self._sm1,*[x[1] for x in self._smL.values()]]:
             if sm is None:continue
             sm.unlink()
         
@@ -498,18 +692,49 @@ class PropCache():
         return self.pwdavg.n_gamma
     
     def get_prop(self,n:int):
-        if not(self.cache):return expm(self.L.L(n)*self.L.dt)
+        if not(self.cache):return expm(dense(self.L.L(n))*self.L.dt)
         U=self.U
         i0,i1=self.index(n),self.step_index(n)
         if not(self.calc_index[i0,i1]):
-            U[i0,i1]=expm(self.L.L(n)*self.L.dt)
+            U[i0,i1]=expm(dense(self.L.L(n))*self.L.dt)
             self.calc_index[i0,i1]=True
+            self.trim()
             
         return U[i0,i1]
 
-            
-    
+
+class LazyArray():
+    def __init__(self,SZ:tuple,dtype):
+        """
+        Storage for propagators of shape SZ=(N,n,d,d), where memory for each 
+        element of the powder average (n,d,d) is only allocated once a 
+        propagator for that element is stored. Indexed with (i0,i1).
+
+        Parameters
+        ----------
+        SZ : tuple
+            Full shape of the stored array.
+        dtype : TYPE
+            Data type.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.shape=tuple(SZ)
+        self.dtype=dtype
+        self._data=[None for _ in range(SZ[0])]
+        self.nbytes=0
         
-    
-            
-        
\ No newline at end of file
+    def __getitem__(self,i):
+        i0,i1=i
+        assert self._data[i0] is not None,"Propagator has not been stored"
+        return self._data[i0][i1]
+    
+    def __setitem__(self,i,U):
+        i0,i1=i
+        if self._data[i0] is None:
+            self._data[i0]=np.zeros(self.shape[1:],dtype=self.dtype)
+            self.nbytes+=self._data[i0].nbytes
+        self._data[i0][i1]=U
@@ -4,7 +4,7 @@ from warnings import warn
 from . import Defaults
 from copy import copy
 import numpy as np
-from .Tools import Ham2Super,BlockDiagonal
+from .Tools import Ham2Super,BlockDiagonal,dense
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MaxNLocator
 from . import Constants
@@ -295,9 +295,9 @@ class RelaxClass():
         
         L=self.L
         
-        Lx,Ly,Lz=[Ham2Super(getattr(self.Op[i],q)) for q in ['x','y','z']]
+        Lx,Ly,Lz=[Ham2Super(getattr(self.Op[i],q),factored=True) for q in ['x','y','z']]
         
-        M=Lx@Lx+Ly@Ly+0*Lz@Lz #This is isotropic (will not transform for 1 spin)
+        M=(Lx@Lx+Ly@Ly).dense() #This is isotropic (will not transform for 1 spin)
         
         N=len(L.H)      #Number of Hamiltonians
         n=L.H[0].shape[0]  #Dimension of Hamiltonians
@@ -377,11 +377,9 @@ class RelaxClass():
         L=self.L
         
         
-        Lz=Ham2Super(self.Op[i].z)
+        Lx,Ly,Lz=[Ham2Super(getattr(self.Op[i],q),factored=True) for q in ['x','y','z']]
         
-        Lx,Ly,Lz=[Ham2Super(getattr(self.Op[i],q)) for q in ['x','y','z']]
-        
-        M=Lx@Lx+Ly@Ly+Lz@Lz #This is isotropic (will not transform for 1 spin)
+        M=(Lx@Lx+Ly@Ly+Lz@Lz).dense() #This is isotropic (will not transform for 1 spin)
         
         N=len(L.H)      #Number of Hamiltonians
         n=L.H[0].shape[0]  #Dimension of Hamiltonians
@@ -447,7 +445,7 @@ class RelaxClass():
         L=self.L
         
 
-        L0=L.Lcoh(step)+L.Lex+L.Lrelax
+        L0=dense(L.Lcoh(step)+L.Lex)+L.Lrelax
         
         _=L.rho_eq(Hindex=0,step=0)
         _=L.Lcoh(step)
@@ -69,10 +69,9 @@ def T1(expsys,i:int,T1:float):
     
     sz=expsys.Op.Mult.prod()
 
-    Lp=Ham2Super(expsys.Op[i].p)
-    Lm=Ham2Super(expsys.Op[i].m)
-    M=Lp@Lm+Lm@Lp
-    M=Lp@Lm
+    Lp=Ham2Super(expsys.Op[i].p,factored=True)
+    Lm=Ham2Super(expsys.Op[i].m,factored=True)
+    M=(Lp@Lm).dense()
     # return -M.real/(2*T1)/M[0,0].real
     
     
@@ -115,11 +114,11 @@ def SpinDiffusion(expsys,i:int,k:float):
 
     """
     
-    Lx=Ham2Super(expsys.Op[i].x)
-    Ly=Ham2Super(expsys.Op[i].y)
-    Lz=Ham2Super(expsys.Op[i].z)
+    Lx=Ham2Super(expsys.Op[i].x,factored=True)
+    Ly=Ham2Super(expsys.Op[i].y,factored=True)
+    Lz=Ham2Super(expsys.Op[i].z,factored=True)
     
-    M=Lx@Lx+Ly@Ly+Lz@Lz
+    M=(Lx@Lx+Ly@Ly+Lz@Lz).dense()
     
     return -k*M
 
@@ -158,8 +157,8 @@ def T2(expsys,i:int,T2:float):
     # out0=np.zeros(N**2,dtype=Defaults['rtype'])
     # out0[i]=1/T2
     
-    Lz=Ham2Super(expsys.Op[i].z)
-    out=(Lz@Lz).astype(bool).astype(Defaults['rtype'])*(-1/T2)
+    Lz=Ham2Super(expsys.Op[i].z,factored=True)
+    out=(Lz@Lz).dense().astype(bool).astype(Defaults['rtype'])*(-1/T2)
     
     return out
 
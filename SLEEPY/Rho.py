@@ -11,7 +11,10 @@ import numpy as np
 import warnings
 import matplotlib.pyplot as plt
 from . import Defaults
-from .Tools import NucInfo,BlockDiagonal
+from .Tools import NucInfo,BlockDiagonal,dense,eig_signal,Ham2Super,prod_tree
+from .Para import StepCalculator
+from scipy.sparse.linalg import expm_multiply
+import scipy.sparse as sps
 import re
 
 
@@ -66,7 +69,7 @@ class Rho():
         
         
         self._awaiting_detection=False  #Detection hanging because L not defined
-        self._taxis=[]
+        self._reset_signal()
         self._t=None
         
         if L is not None:self.L=L
@@ -76,7 +79,6 @@ class Rho():
         # self._Setup()
         self.apodize=False
         self._block=None
-        self._phase_accum=None
         self._phase_accum0=None
         self._downmixed=False
         self.apod_pars={'WDW':'em','LB':None,'SSB':2,'GB':15}
@@ -159,10 +161,12 @@ class Rho():
             Array of all times at which the detection was performed.
 
         """
-        if self._tstatus:
-            return np.sort(self._taxis)
-        else:
-            return np.array(self._taxis)
+        t=self._taxis
+        if self._tstatus and np.any(np.diff(t)<0):
+            t=np.sort(t)
+        t=t.view()
+        t.flags.writeable=False
+        return t
     
     @property
     def _tstatus(self):
@@ -194,7 +198,80 @@ class Rho():
     
     @property
     def phase_accum(self):
-        return np.array(self._phase_accum).T
+        pa=self._phase_accum.T
+        pa.flags.writeable=False
+        return pa
+    
+    #%% Storage of detected signals
+    @property
+    def _Ipwd(self):
+        if self._Ibuf is None:return None
+        return self._Ibuf[...,:self._nt]
+    
+    @property
+    def _taxis(self):
+        return self._tbuf[:self._nt]
+    
+    @property
+    def _phase_accum(self):
+        return self._pbuf[:self._nt]
+    
+    def _reset_signal(self):
+        """
+        Empties the buffers of detected signals, detection times, and 
+        accumulated phases
+        """
+        self._Ibuf=None
+        self._Iavg=None
+        self._FTcache={}
+        self._tbuf=np.zeros(0,dtype=rtype)
+        self._pbuf=np.zeros([0,0],dtype=rtype)
+        self._nt=0
+        
+    def _record(self,I,t,phase_accum):
+        """
+        Stores detected signals in the preallocated buffers. The buffers grow
+        in chunks (doubling in size), such that storage is contiguous 
+        (Npwd x Nd x capacity) and repeated detection does not reallocate.
+        The powder-averaged signal is accumulated at the same time, and stored
+        Fourier transforms are discarded.
+
+        Parameters
+        ----------
+        I : np.array
+            Detected signals (Npwd,Nd,n)
+        t : np.array
+            Detection times (n)
+        phase_accum : np.array
+            Accumulated phases (n,nspins)
+
+        Returns
+        -------
+        None.
+
+        """
+        t=np.atleast_1d(t)
+        n0,n1=self._nt,self._nt+t.size
+        if self._Ibuf is None or n1>self._tbuf.size:
+            cap=max(n1,2*self._tbuf.size,256)
+            Ibuf=np.zeros([*I.shape[:-1],cap],dtype=ctype)
+            Iavg=np.zeros([*I.shape[1:-1],cap],dtype=ctype)
+            tbuf=np.zeros(cap,dtype=rtype)
+            pbuf=np.zeros([cap,np.shape(phase_accum)[-1]],dtype=rtype)
+            if n0:
+                Ibuf[...,:n0]=self._Ipwd
+                Iavg[...,:n0]=self._Iavg[...,:n0]
+                tbuf[:n0]=self._taxis
+                pbuf[:n0]=self._phase_accum
+            self._Ibuf,self._Iavg,self._tbuf,self._pbuf=Ibuf,Iavg,tbuf,pbuf
+        self._Ibuf[...,n0:n1]=I
+        self._Iavg[...,n0:n1]=np.tensordot(self.pwdavg.weight,I,axes=(0,0))
+        self._tbuf[n0:n1]=t
+        self._pbuf[n0:n1]=phase_accum
+        self._nt=n1
+        self._FTcache={}
+        
+    #%% Other properties
     
     @property
     def reduced(self):
@@ -225,45 +302,49 @@ class Rho():
 
         """
         if self.L is None:self.L=seq_U[0].L  #Initialize self if necessary
+        L=self.L
         
-        
-        ini_fields=copy(self.L.rf.fields) #Store initial field settings
-        rf=self.L.rf
-        for k in rf.fields:rf.add_field(k) #Set all fields first to zero
-        
-        x=np.zeros(self.L.shape,dtype=bool)
+        # Channels that may be active (sequences and current fields)
+        channels={k for k,v in enumerate(L.rf.fields.values()) if v[0]}
+        U_calc=[]   #Calculated propagators (structure obtained from the propagator itself)
         for seq0 in seq_U:
             if hasattr(seq0,'rf') or not(seq0.calculated):
                 v10=seq0.v1 if hasattr(seq0,'rf') else seq0.U['v1']
-                    
-                for k,v1 in enumerate(v10):
-                    if np.any(v1):rf.add_field(k,v1=1) #Turn field on
-                    x+=self.L.Lrf.astype(bool)  #Add it to the logical matrix
-                    rf.add_field(k) #Turn field off
+                channels.update(k for k,v1 in enumerate(v10) if np.any(v1))
             else:
-                x+=np.abs(seq0[0])>1e-5  #Tolerance ok?
-                # We try to avoid any weird orientations that are missing cross terms so check a few orientations
-                x+=np.abs(seq0[len(self.L)//2])>1e-5
-                x+=np.abs(seq0[len(self.L)//3])>1e-5  #Tolerance ok?
-                x+=np.abs(seq0[len(self.L)//4])>1e-5  #Tolerance ok?
-
+                U_calc.append(seq0)
+        
+        rho=self._rho.astype(bool).any(0)
+        detect=self._detect.astype(bool).any(0)
+        
+        key=(tuple(sorted(channels)),rho.tobytes(),detect.tobytes())
+        if not(U_calc) and key in L._block_structure:
+            return L._block_structure[key]
         
-        rf.fields=ini_fields
+        # Symbolic structure: rf terms from the spin operators, and all rotating
+        # components of the Liouvillian (exchange/relaxation included) for a 
+        # few orientations
+        nHam=len(L.H)
+        x=sps.csr_matrix(L.shape,dtype=bool)
+        for k in channels:
+            Lrf0=Ham2Super(self.expsys.Op[k].x,sparse=True)
+            Lrf=sps.block_diag([Lrf0 for _ in range(nHam)],format='csr').astype(bool)
+            x=x+(Lrf[L.block][:,L.block] if L.reduced else Lrf)
+        
+        for seq0 in U_calc:
+            for i in [0,len(L)//2,len(L)//3,len(L)//4]:
+                x=x+sps.csr_matrix(np.abs(seq0[i])>1e-5)  #Tolerance ok?
         
-        x+=self.L[0].L(0).astype(bool)
         # We try to avoid any weird orientations that are missing cross terms so check a few orientations
-        x+=self.L[len(self.L)//2].L(0).astype(bool)
-        x+=self.L[len(self.L)//3].L(0).astype(bool)
-        x+=self.L[1*len(self.L)//4].L(0).astype(bool)
-        
-        
-        B=BlockDiagonal(x)
-        blocks=[]
-        rho=np.array(self._rho,dtype=bool).sum(0).astype(bool)
-        detect=np.array(self._detect,dtype=bool).sum(0).astype(bool)
-        for b in B:
-            if np.any(rho[b]) and np.any(detect[b]):
-                blocks.append(b)
+        for i in [0,len(L)//2,len(L)//3,len(L)//4]:
+            L0=L[i]
+            for n in range(-2,3):
+                x=x+sps.csr_matrix(L0.Ln(n)).astype(bool)
+            if L0.LrelaxOS.active:
+                x=x+sps.csr_matrix(L0.LrelaxOS(0)).astype(bool)
+        
+        blocks=[b for b in BlockDiagonal(x) if np.any(rho[b]) and np.any(detect[b])]
+        if not(U_calc) and Defaults['cache']:L._block_structure[key]=blocks
         return blocks
     
     def getBlock(self,block):
@@ -286,11 +367,9 @@ class Rho():
         rho._L=self.L.getBlock(block)
         rho._rho0=[rho0[block] for rho0 in self._rho0] if isinstance(self._rho0,list) else self._rho0[block]
         # rho._rho0=self._rho0[block]
-        rho._detect=[d[block] for d in self._detect]
-        rho._rho=[r[block] for r in self._rho]
-        rho._Ipwd=[[[] for _ in range(len(self._detect))] for _ in range(len(self.L))]
-        rho._taxis=[]
-        self._phase_accum=list()
+        rho._detect=self._detect[:,block]
+        rho._rho=self._rho[:,block]
+        rho._reset_signal()
         rho.Reduce=False
         
         return rho
@@ -355,8 +434,8 @@ class Rho():
         block=np.sum(blocks,axis=0).astype(bool)
         self._rho0=[rho0[block] for rho0 in self._rho0] if isinstance(self._rho0,list) else self._rho0[block]
         # self._rho0=self._rho0[block]
-        self._detect=[d[block] for d in self._detect]
-        self._rho=[r[block] for r in self._rho]
+        self._detect=self._detect[:,block]
+        self._rho=self._rho[:,block]
         self.Reduce=False
         self.block=block
         if seq.reduced:
@@ -407,7 +486,7 @@ class Rho():
             q=np.ones(len(self.t_axis),dtype=ctype)
             for i,(ph_acc,co0) in enumerate(zip(self.phase_accum,co)):
                 if self.expsys.LF[i]:  #Add phase from LF rotation if necessary
-                    ph_acc+=self.expsys.v0[i]*2*np.pi*(self.t_axis-t0)
+                    ph_acc=ph_acc+self.expsys.v0[i]*2*np.pi*(self.t_axis-t0)
                 if np.unique(co0[detect]).__len__()==1:
                     q*=np.exp(1j*ph_acc*co0[detect][0])
                 elif np.unique(np.abs(co0[detect])).__len__()==1:
@@ -419,9 +498,9 @@ class Rho():
             Ipwd=self.Ipwd[:,k]
             if baseline:
                 Ipwd=(Ipwd.T-Ipwd.mean(-1)).T
-            Idm=Ipwd*q
-            for m in range(self.pwdavg.N):
-                self._Ipwd[m][k]=Idm[m].tolist()
+            self._Ipwd[:,k]=Ipwd*q  #Replace in the stored signal
+            self._Iavg[k,:self._nt]=self.pwdavg.weight@self._Ipwd[:,k]
+        self._FTcache={}
         
         self._downmixed=True
                 
@@ -464,12 +543,13 @@ class Rho():
         None.
 
         """
-        if len(self.t_axis):
-            if self._tstatus:
-                i=np.argsort(self._taxis)
-                return np.array(self._Ipwd).T[i].T
-            else:
-                return np.array(self._Ipwd)
+        if self._nt:
+            I=self._Ipwd  #View of the stored signal (no copy if time axis is sorted)
+            if self._tstatus and np.any(np.diff(self._taxis)<0):
+                I=I[...,np.argsort(self._taxis,kind='stable')]
+            I=I.view()
+            I.flags.writeable=False
+            return I
     
     @property
     def I(self):
@@ -483,7 +563,13 @@ class Rho():
         None.
 
         """
-        return (self.Ipwd.T*self.pwdavg.weight).sum(-1).T
+        if self._nt:
+            I=self._Iavg[:,:self._nt]  #Powder sum is accumulated at detection
+            if self._tstatus and np.any(np.diff(self._taxis)<0):
+                I=I[...,np.argsort(self._taxis,kind='stable')]
+            I=I.view()
+            I.flags.writeable=False
+            return I
     
     @property
     def v_axis(self):
@@ -501,56 +587,89 @@ class Rho():
         
     
     @property
-    def FT(self):
+    def _apod_key(self):
+        """
+        Key for the stored Fourier transforms (depends on the apodization)
+        """
+        return (self.apodize,*self.apod_pars.items()) if self.apodize else (False,)
+    
+    def _apodization(self):
         """
-        Fourier transform of the time-dependent signal
+        Apodization function for the current time axis, determined by 
+        self.apod_pars. Returns None if self.apodize is False.
 
         Returns
         -------
         np.array
-            FT, including division of the first time point by zero.
 
+        """
+        if not(self.apodize):return None
+        ap=self.apod_pars
+        wdw=ap['WDW'].lower()
+        t=self.t_axis
+        LB=ap['LB'] if ap['LB'] is not None else 5/t[-1]/np.pi
+        
+        if wdw=='em':
+            apod=np.exp(-t*LB*np.pi)
+        elif wdw=='gm':
+            apod=np.exp(-np.pi*LB*t+(np.pi*LB*t**2)/(2*ap['GB']*t[-1]))
+        elif wdw=='sine':
+            if ap['SSB']>=2:
+                apod=np.sin(np.pi*(1-1/ap['SSB'])*t/t[-1]+np.pi/ap['SSB'])
+            else:
+                apod=np.sin(np.pi*t/t[-1])
+        elif wdw=='qsine':
+            if ap['SSB']>=2:
+                apod=np.sin(np.pi*(1-1/ap['SSB'])*t/t[-1]+np.pi/ap['SSB'])**2
+            else:
+                apod=np.sin(np.pi*t/t[-1])**2
+        elif wdw=='sinc':
+            apod=np.sin(2*np.pi*ap['SSB']*(t/t[-1]-ap['GB']))
+        elif wdw=='qsinc':
+            apod=np.sin(2*np.pi*ap['SSB']*(t/t[-1]-ap['GB']))**2
+        else:
+            warnings.warn(f'Unrecognized apodization function: "{wdw}"')
+            apod=np.ones(t.shape)
+        return apod
+    
+    def _fft(self,I):
+        """
+        Fourier transform along the last axis of I (first time point divided
+        by 2, apodization applied, zero-filled to twice the length)
         """
         if self._tstatus!=1:
             warnings.warn('Time points are not equally spaced. FT will be incorrect')
+        
+        I=np.concatenate((I[...,:1]/2,I[...,1:]),axis=-1)
+        apod=self._apodization()
+        if apod is not None:I*=apod
+        out=np.fft.fftshift(np.fft.fft(I,n=I.shape[-1]*2,axis=-1),axes=[-1])
+        out.flags.writeable=False
+        return out
+    
+    @property
+    def FT(self):
+        """
+        Fourier transform of the time-dependent signal. Stored until the next
+        detection or a change of the apodization.
 
-        I=np.concatenate((self.I[:,:1]/2,self.I[:,1:]),axis=1)
-        if self.apodize:
-            ap=self.apod_pars
-            wdw=ap['WDW'].lower()
-            t=self.t_axis
-            LB=ap['LB'] if ap['LB'] is not None else 5/t[-1]/np.pi
-            
-            if wdw=='em':
-                apod=np.exp(-t*LB*np.pi)
-            elif wdw=='gm':
-                apod=np.exp(-np.pi*LB*t+(np.pi*LB*t**2)/(2*ap['GB']*t[-1]))
-            elif wdw=='sine':
-                if ap['SSB']>=2:
-                    apod=np.sin(np.pi*(1-1/ap['SSB'])*t/t[-1]+np.pi/ap['SSB'])
-                else:
-                    apod=np.sin(np.pi*t/t[-1])
-            elif wdw=='qsine':
-                if ap['SSB']>=2:
-                    apod=np.sin(np.pi*(1-1/ap['SSB'])*t/t[-1]+np.pi/ap['SSB'])**2
-                else:
-                    apod=np.sin(np.pi*t/t[-1])**2
-            elif wdw=='sinc':
-                apod=np.sin(2*np.pi*ap['SSB']*(t/t[-1]-ap['GB']))
-            elif wdw=='qsinc':
-                apod=np.sin(2*np.pi*ap['SSB']*(t/t[-1]-ap['GB']))**2
-            else:
-                warnings.warn(f'Unrecognized apodization function: "{wdw}"')
-                apod=np.ones(t.shape)
-            I*=apod
+        Returns
+        -------
+        np.array
+            FT, including division of the first time point by zero.
 
-            
-        return np.fft.fftshift(np.fft.fft(I,n=I.shape[1]*2,axis=1),axes=[1])
+        """
+        key=('FT',*self._apod_key)
+        if key not in self._FTcache:
+            self._FTcache[key]=self._fft(self.I)
+        return self._FTcache[key]
     
     @property
     def FTpwd(self):
         """
-        Fourier transform of the time-dependent signal
+        Fourier transform of the time-dependent signal for each element of
+        the powder average. Stored until the next detection or a change of
+        the apodization.
 
         Returns
         -------
@@ -558,45 +677,10 @@ class Rho():
             FT, including division of the first time point by zero.
 
         """
-        
-        if self._FTpwd is None:
-            if self._tstatus!=1:
-                warnings.warn('Time points are not equally spaced. FT will be incorrect')
-    
-            I=np.concatenate((self.Ipwd[:,:,:1]/2,self.Ipwd[:,:,1:]),axis=-1)
-            if self.apodize:
-                ap=self.apod_pars
-                wdw=ap['WDW'].lower()
-                t=self.t_axis
-                LB=ap['LB'] if ap['LB'] is not None else 5/t[-1]/np.pi
-                
-                if wdw=='em':
-                    apod=np.exp(-t*LB*np.pi)
-                elif wdw=='gm':
-                    apod=np.exp(-np.pi*LB*t+(np.pi*LB*t**2)/(2*ap['GB']*t[-1]))
-                elif wdw=='sine':
-                    if ap['SSB']>=2:
-                        apod=np.sin(np.pi*(1-1/ap['SSB'])*t/t[-1]+np.pi/ap['SSB'])
-                    else:
-                        apod=np.sin(np.pi*t/t[-1])
-                elif wdw=='qsine':
-                    if ap['SSB']>=2:
-                        apod=np.sin(np.pi*(1-1/ap['SSB'])*t/t[-1]+np.pi/ap['SSB'])**2
-                    else:
-                        apod=np.sin(np.pi*t/t[-1])**2
-                elif wdw=='sinc':
-                    apod=np.sin(2*np.pi*ap['SSB']*(t/t[-1]-ap['GB']))
-                elif wdw=='qsinc':
-                    apod=np.sin(2*np.pi*ap['SSB']*(t/t[-1]-ap['GB']))**2
-                else:
-                    warnings.warn(f'Unrecognized apodization function: "{wdw}"')
-                    apod=np.ones(t.shape)
-                I*=apod
-    
-                
-            self._FTpwd=np.fft.fftshift(np.fft.fft(I,n=I.shape[-1]*2,axis=-1),axes=[-1])
-        
-        return self._FTpwd
+        key=('FTpwd',*self._apod_key)
+        if key not in self._FTcache:
+            self._FTcache[key]=self._fft(self.Ipwd)
+        return self._FTcache[key]
     
     def _Setup(self):
         """
@@ -611,10 +695,7 @@ class Rho():
 
         """
         
-        self._Ipwd=[[list() for _ in range(self.n_det)] for _ in range(self.pwdavg.N)]
-        self._FTpwd=None
-        self._taxis=list()
-        self._phase_accum=list()
+        self._reset_signal()
         
         
         if isinstance(self.rho0,str) and self.rho0=='Thermal':
@@ -630,7 +711,7 @@ class Rho():
             self._rho0=rhoeq
         else:
             self._rho0=self.Op2vec(self.strOp2vec(self.rho0))
-        self._detect=[self.Op2vec(self.strOp2vec(det,detect=True),detect=True) for det in self.detect]
+        self._detect=np.array([self.Op2vec(self.strOp2vec(det,detect=True),detect=True) for det in self.detect])
         for k,det in enumerate(self._detect):
             if np.any(np.isnan(det)):
                 warnings.warn(f'Detector {k} is not valid')
@@ -654,7 +735,9 @@ class Rho():
 
         """
         if self.L is not None:
-            self._rho=self._rho0 if isinstance(self._rho0,list) else [self._rho0 for _ in range(self.pwdavg.N)]
+            #Density matrices stacked over the powder average (Npwd,d)
+            self._rho=np.array(self._rho0,dtype=ctype) if isinstance(self._rho0,list) else \
+                np.repeat([self._rho0],self.pwdavg.N,axis=0).astype(ctype)
             self._phase_accum0=np.zeros(self.expsys.nspins)
         self._t=None
         
@@ -681,10 +764,8 @@ class Rho():
         
         self._t=None
         
-        self._Ipwd=[[]]
-        self._FTpwd=None
-        self._taxis=list()
-        self._rho=list() #Storage for numerical rho
+        self._reset_signal()
+        self._rho=None #Storage for numerical rho
         self._L=None
         self._BDP=False
         self._downmixed=False
@@ -710,6 +791,23 @@ class Rho():
         
         if hasattr(U,'add_channel'):U=U.U() #Sequence provided
         
+        self._prop_setup(U)
+            
+        if U.calculated:
+            self._rho=(U.U@self._rho[...,None])[...,0]  #Batched over the powder average
+        elif Defaults['krylov']:
+            self.prop_krylov(U)
+        else:
+            U.calcU()
+            self._rho=(U.U@self._rho[...,None])[...,0]  #Batched over the powder average
+        
+        return self._prop_finish(U)
+    
+    def _prop_setup(self,U):
+        """
+        Checks and initialization (L, current time, pending detection) 
+        required before applying the propagator U
+        """
         if self._BDP:
             warnings.warn('Block-diagonal propagation was previously used. Propagator is set to time point BEFORE block-diagonal propagation.')
                    
@@ -733,34 +831,13 @@ class Rho():
         assert U.block.sum(0)==self.block.sum(0),"Different matrix reduction applied to propagators (cannot be multiplied)"
         if not(np.all(U.block==self.block)):
             warnings.warn('\nMatrix blocks do not match. This is almost always wrong')
-        
-        
-            
-        if U.calculated:
-            self._rho=[U0@rho for U0,rho in zip(U,self._rho)]
-            self._t+=U.Dt
-            
-        else:
-            # This approach is incomplete and should not be used!
-            
-            dct=U.U
-            t=dct['t']
-            L=U.L
-            ini_fields=copy(L.fields)
-            
-            for m,(ta,tb) in enumerate(zip(t[:-1],t[1:])):
-                for k,(v1,phase,voff) in enumerate(zip(dct['v1'],dct['phase'],dct['voff'])):
-                    L.fields[k]=(v1[m],phase[m],voff[m])
-            
-                    #TODO
-                    # AT THIS POINT, WE NEED TO APPLY THE PROPAGATOR TO RHO
-                    # OVER DIFFERENT ROTOR POSITIONS. FOR EXAMPLE, CHECK THE
-                    # L.U MACHINERY. ALSO SHOULD BE SET UP FOR PARALLEL PROCESSING
-                    
-            
-            L.fields.update(ini_fields)  #Return fields to their initial state
-            self._t+=U.Dt
-        
+        return self
+    
+    def _prop_finish(self,U):
+        """
+        Advances the current time and accumulated phase after applying U
+        """
+        self._t+=U.Dt
         self._phase_accum0+=U.phase_accum
         self._phase_accum0%=2*np.pi
         
@@ -768,6 +845,64 @@ class Rho():
                     
                 
         
+    def prop_krylov(self,U):
+        """
+        Applies an uncalculated propagator (Sequence.U) to the density matrix
+        without forming the propagator matrices. The density matrix is stepped
+        through the Liouvillian of each step of the rotor period, using the 
+        action of the matrix exponential on a vector (expm_multiply). Used 
+        for propagation if Defaults['krylov'] is True, which may be favorable
+        for large spin systems.
+        
+        Note that this trades memory for time: each call repeats one 
+        expm_multiply per step of the rotor period and per powder element, 
+        such that repeated application of the same sequence (e.g. DetProp) 
+        is typically 10-100x slower than calculating the propagator once. 
+        Only use if the propagators do not fit in memory.
+
+        Parameters
+        ----------
+        U : Propagator
+            Uncalculated propagator
+
+        Returns
+        -------
+        self
+
+        """
+        dct=U.U
+        t=dct['t']
+        L=U.L
+        ini_fields=copy(L.fields)
+        
+        steps=[]
+        for ta,tb in zip(t[:-1],t[1:]):
+            if tb-ta<=0:
+                steps.append([])
+            elif L.static:
+                steps.append([(0,tb-ta)])
+            else:
+                n0,nf,tm1,tp1=StepCalculator(t0=ta,Dt=tb-ta,dt=L.dt)
+                steps.append([(n0,tm1),*[(n,L.dt) for n in range(n0+1,nf)]])
+                if tp1>1e-10:steps[-1].append((nf,tp1))
+        
+        for k,L0 in enumerate(L):  #Loop over the powder average first, so Ln is only built once per element
+            Ln=[L0.Ln(q) for q in range(-2,3)]
+            for m,st in enumerate(steps):
+                for q,(v1,phase,voff) in enumerate(zip(dct['v1'],dct['phase'],dct['voff'])):
+                    L.fields[q]=(v1[m],phase[m],voff[m])
+                Lrf=L0.Lrf
+                for n,dt in st:
+                    ph=np.exp(1j*2*np.pi*n/L.expsys.n_gamma)
+                    Lstep=sum([Ln0*(ph**(-q)) for Ln0,q in zip(Ln,range(-2,3))])+Lrf
+                    if L0.LrelaxOS.active:
+                        R=L0.LrelaxOS(n)
+                        Lstep=Lstep+(sps.csr_matrix(R) if sps.issparse(Lstep) else R)
+                    self._rho[k]=expm_multiply(Lstep*dt,self._rho[k])
+        
+        L.fields.update(ini_fields)  #Return fields to their initial state
+        return self
+    
     def __rmul__(self,U):
         """
         Runs rho.prop(U) and returns self.
@@ -785,7 +920,7 @@ class Rho():
 
         """
         if hasattr(U,'add_channel'):U=U.U() #Sequence provided
-        U.calcU()
+        if not(Defaults['krylov']):U.calcU()
         return self.prop(U)
     
     def __mul__(self,U):
@@ -826,11 +961,7 @@ class Rho():
             self._awaiting_detection=True
             return self
         
-        self._taxis.append(self.t)
-        self._phase_accum.append(self._phase_accum0)
-        for k,rho in enumerate(self._rho):
-            for m,det in enumerate(self._detect):
-                self._Ipwd[k][m].append((rho*det).sum())
+        self._record((self._rho@self._detect.T)[...,None],self.t,self._phase_accum0)  #All orientations and detectors at once
         return self
     
         
@@ -858,11 +989,20 @@ class Rho():
         if self.L is not None:
             return self.L.__len__()
     
-    def DetProp(self,U=None,seq=None,n:int=5000,n_per_seq:int=1):
+    def DetProp(self,U=None,seq=None,n:int=5000,n_per_seq:int=1,others:list=None):
         """
         Executes a series of propagation/detection steps. Detection occurs first,
         followed by propagation, with the sequence repeated for n steps. 
         If n>100, then we will use eigenvalue decomposition for the propagation
+        
+        Several initial states and/or detection operators may be propagated 
+        together by providing additional Rho objects (others). Propagators 
+        and their eigendecompositions are then calculated only once for all
+        Rho objects, which should be at the same time point.
+        
+        rho=sl.Rho('13Cx','13Cx')
+        rho1=sl.Rho('13Cz',['13Cz','1Hz'])
+        rho.DetProp(seq,n=500,others=[rho1])
 
         Parameters
         ----------
@@ -876,6 +1016,9 @@ class Rho():
         n_per_seq : int, optional 
             Allows one to break a sequence into steps, e.g. to obtain a larger
             spectral width.
+        others : list, optional
+            Additional Rho objects to propagate/detect with the same propagators.
+            The default is None.
 
         Returns
         -------
@@ -884,9 +1027,12 @@ class Rho():
         """
         assert not(U is None and seq is None),"Either U or seq must be defined"
         
+        others=[] if others is None else list(others)
+        rhos=[self,*others]
         
-        if self._BDP:
-            warnings.warn('Block-diagonal propagation was previously used. Propagator is set to time point BEFORE block-diagonal propagation.')
+        for rho in rhos:
+            if rho._BDP:
+                warnings.warn('Block-diagonal propagation was previously used. Propagator is set to time point BEFORE block-diagonal propagation.')
         
         if seq is None and not(hasattr(U,'calcU')):
             seq=U
@@ -897,15 +1043,26 @@ class Rho():
             warnings.warn('Both U and seq are defined. seq will not be used')
             seq=None
         
-        if self.L is None:
-            if U is not None:
-                self.L=U.L
-            else:
-                self.L=seq.L
+        for rho in rhos:
+            if rho.L is None:
+                if U is not None:
+                    rho.L=U.L
+                else:
+                    rho.L=seq.L
         
         # Block-diagonal propagation
         if seq is not None and self.Reduce:
-            rb,sb=self.ReducedSetup(seq)
+            if len(others):  #Common reduction for all Rho objects
+                block=np.sum([b for rho in rhos for b in rho.Blocks(seq)],axis=0).astype(bool)
+                rb=[rho.getBlock(block) for rho in rhos]
+                sb=seq.getBlock(block)
+                for r in rb[1:]:r._L=rb[0].L
+                sb.L=rb[0].L
+                if Defaults['verbose'] and block.sum()<len(block):
+                    print(f'State-space reduction: {block.__len__()}->{block.sum()}')
+            else:
+                rb,sb=self.ReducedSetup(seq)
+                rb=[rb]
             
             # blocks=self.Blocks(seq)
             # block=np.sum(blocks,0).astype(bool)
@@ -916,15 +1073,11 @@ class Rho():
             #     rb=self.getBlock(block)
             #     sb=seq.getBlock(block)
             
-            rb.DetProp(seq=sb,n=n,n_per_seq=n_per_seq)
-            Ipwd=rb.Ipwd
-            for k in range(Ipwd.shape[0]):
-                for j in range(Ipwd.shape[1]):
-                    self._Ipwd[k][j].extend(Ipwd[k,j])
-            self._taxis.extend(rb._taxis)
-            self._phase_accum.extend(rb._phase_accum)
-            self._BDP=True
-            self._t=rb._t
+            rb[0].DetProp(seq=sb,n=n,n_per_seq=n_per_seq,others=rb[1:])
+            for rho,r in zip(rhos,rb):
+                if r._nt:rho._record(r._Ipwd,r._taxis,r._phase_accum)
+                rho._BDP=True
+                rho._t=r._t
             return self
                 
             
@@ -932,45 +1085,49 @@ class Rho():
 
         
         
-        if U is not None:
-            if self._t is None:self._t=U.t0
-            if not(self.static) and np.abs((self.t-U.t0)%self.taur)>tol and np.abs((U.t0-self.t)%self.taur)>tol:
-                warnings.warn('The initial time of the propagator is not equal to the current time of the density matrix')
-            if not(self.static) and np.abs(U.Dt%self.taur)>tol and np.abs((self.taur-U.Dt)%self.taur)>tol:
-                warnings.warn('The propagator length is not an integer multiple of the rotor period')
-         
-        elif self._t is None:
-            self._t=0
+        for rho in rhos:
+            if U is not None:
+                if rho._t is None:rho._t=U.t0
+                if not(rho.static) and np.abs((rho.t-U.t0)%rho.taur)>tol and np.abs((U.t0-rho.t)%rho.taur)>tol:
+                    warnings.warn('The initial time of the propagator is not equal to the current time of the density matrix')
+                if not(rho.static) and np.abs(U.Dt%rho.taur)>tol and np.abs((rho.taur-U.Dt)%rho.taur)>tol:
+                    warnings.warn('The propagator length is not an integer multiple of the rotor period')
+             
+            elif rho._t is None:
+                rho._t=0
         
         if U is not None:
-            if n>=100:
-                self()  #This is the initial detection
+            if n>=100 and (U.calculated or not(Defaults['krylov'])):
                 U.eig()
-                for k,((d,v),rho) in enumerate(zip(U._eig,self)):
-                    rho0=np.linalg.pinv(v)@rho
-                    dp=np.cumprod(np.repeat([d],n,axis=0),axis=0)
-                    rho_d=dp*rho0
-                    self._rho[k]=v@rho_d[-1]
-                    for m,det in enumerate(self._detect):
-                        det_d=det@v
-                        self._Ipwd[k][m].extend((det_d*rho_d[:-1]).sum(-1))
-                
-                self._taxis.extend([self.t+k*U.Dt for k in range(1,n)])
-                self._t+=n*U.Dt
-                self._phase_accum.extend([(self._phase_accum0+k*U.phase_accum)%(2*np.pi) for k in range(1,n)])
-                self._phase_accum0=(self._phase_accum0+n*U.phase_accum)%(2*np.pi)
+                d,v,vi=[np.array(x) for x in zip(*U._eig)]  #Stacked over the powder average
+                for rho in rhos:rho()  #This is the initial detection
+                # Only the detector and initial state are transformed to the eigenbasis
+                # The density matrix is not calculated at the intermediate time points
+                R0=vi@np.stack([rho._rho for rho in rhos],axis=-1)  #All Rho objects in one product
+                X=v@((d**n)[...,None]*R0)
+                k=np.arange(1,n)
+                for j,rho in enumerate(rhos):
+                    rho._record(eig_signal(d,(rho._detect@v)*R0[:,None,:,j],n-1,start=1),
+                                rho.t+k*U.Dt,(rho._phase_accum0+k[:,None]*U.phase_accum)%(2*np.pi))
+                    rho._rho=np.ascontiguousarray(X[...,j])
+                    
+                    rho._t+=n*U.Dt
+                    rho._phase_accum0=(rho._phase_accum0+n*U.phase_accum)%(2*np.pi)
                     
             else:
+                if n>=100:
+                    warnings.warn('Krylov mode re-applies the sequence step-by-step for all n steps, which is much slower than the dense path. Set Defaults["krylov"]=False unless the propagators do not fit in memory')
                 for _ in range(n):
-                    U*self()
+                    for rho in rhos:rho()
+                    _prop_stack(U,rhos)
         else:
             # TODO set n_per_seq functionality here
             if self.static:
-                return self.DetProp(U=seq.U(),n=n)
+                return self.DetProp(U=seq.U(),n=n,others=others)
             
             if (seq.Dt%seq.taur<tol or -seq.Dt%seq.taur<tol) and n_per_seq==1:
                 U=seq.U(t0=self.t,Dt=seq.Dt)  #Just generate the propagator and call with U
-                self.DetProp(U=U,n=n)
+                self.DetProp(U=U,n=n,others=others)
                 return self
             
             if seq.Dt<seq.taur:
@@ -1002,44 +1159,47 @@ class Rho():
             
             U=[seq.U(Dt=Dt,t0_seq=k*Dt) for k in range(nsteps)]
             
-            if n//nsteps>100:
+            if n//nsteps>100 and not(Defaults['krylov']):
                 U0=[]
-                Ipwd=np.zeros([len(self),len(self._detect),n],dtype=ctype)
-                phase_accum=np.ones([n,self.expsys.nspins],dtype=rtype)*self._phase_accum0
+                Ipwd=[np.zeros([len(rho),len(rho._detect),n],dtype=ctype) for rho in rhos]
+                phase_accum=[np.ones([n,self.expsys.nspins],dtype=rtype)*rho._phase_accum0 for rho in rhos]
+                
+                R00=np.stack([rho._rho for rho in rhos],axis=-1)  #(Npwd,d,n_rho)
+                
+                for U1 in U:U1.calcU()  #Calculate in order (sets the current time in the rotor period)
+                
+                # Partial products shared between starting times (parallel prefix)
+                Us=np.array([U1.U for U1 in U])
+                Suf=prod_tree(Us,partial=True)  #Suf[q]=U[nsteps-1]@...@U[q]
+                Pre=np.swapaxes(prod_tree(np.swapaxes(Us[::-1],-1,-2),partial=True)[::-1],-1,-2) #Pre[q]=U[q]@...@U[0]
+                Urot=np.concatenate((Suf[:1],Pre[:-1]@Suf[1:]))  #Rotor period starting at each step
+                phase=np.sum([U1.phase_accum for U1 in U],axis=0)
                 
-                rho00=copy(self._rho)
                 for q in range(nsteps):  #Loop over the starting time
                     n0=n//nsteps+(q<n%nsteps)
-                    U0=U[q]
-                    for m in range(q+1,q+nsteps):U0=U[m%nsteps]*U0 #Calculate propagator for 1 rotor period starting U[q]
+                    U0=U[q].__class__(Urot[q],t0=U[q].t0,tf=U[q].t0+nsteps*Dt,taur=U[q].taur,
+                                      L=U[q].L,isotropic=U[q].isotropic,phase_accum=phase) #Propagator for 1 rotor period starting U[q]
                     U0.eig()
-                    phase_accum[q::nsteps]+=U0.phase_accum*np.repeat([np.arange(n0)],self.expsys.nspins,axis=0).T
-                    for k,((d,v),rho0) in enumerate(zip(U0._eig,rho00)):  #Sweep over the powder average
-                        rho0=np.linalg.pinv(v)@rho0
-                        dp=np.concatenate([np.ones([1,d.size],dtype=ctype),
-                                           np.cumprod(np.repeat([d],n0-1,axis=0),axis=0)],axis=0)
-                        rho_d=dp*rho0
-                        for m,det in enumerate(self._detect):
-                            det_d=det@v
-                            Ipwd[k][m][q::nsteps]=(det_d*rho_d).sum(-1)
-                        if q==nsteps-1:
-                            self._rho[k]=v@rho_d[-1]
-                            
-                        rho00[k]=U[q][k]@rho00[k] #Step forward by 1/nsteps rotor period for the next step
+                    for pa in phase_accum:
+                        pa[q::nsteps]+=U0.phase_accum*np.repeat([np.arange(n0)],self.expsys.nspins,axis=0).T
+                    d,v,vi=[np.array(x) for x in zip(*U0._eig)]  #Stacked over the powder average
+                    R0=vi@R00  #Same eigendecomposition for all Rho objects
+                    for j,(rho,Ipwd0) in enumerate(zip(rhos,Ipwd)):
+                        Ipwd0[...,q::nsteps]=eig_signal(d,(rho._detect@v)*R0[:,None,:,j],n0)
+                    if q==nsteps-1:
+                        X=v@((d**(n0-1))[...,None]*R0)
+                        for j,rho in enumerate(rhos):rho._rho=np.ascontiguousarray(X[...,j])
+                    R00=U[q].U@R00  #Step forward by 1/nsteps rotor period for the next step
                         
-                for k in range(len(self)):
-                    for m in range(len(self._detect)):
-                        self._Ipwd[k][m].extend(Ipwd[k][m].tolist())
-                
-                self._taxis.extend([self.t+k*Dt for k in range(0,n)])
-                
-                self._phase_accum.extend([pa%(2*np.pi) for pa in phase_accum])
-                self._phase_accum0=self._phase_accum[-1]
-                self._t+=n*Dt
+                for rho,Ipwd0,pa in zip(rhos,Ipwd,phase_accum):
+                    rho._record(Ipwd0,rho.t+np.arange(n)*Dt,pa%(2*np.pi))
+                    rho._phase_accum0=rho._phase_accum[-1].copy()
+                    rho._t+=n*Dt
                         
             else:
                 for k in range(n):
-                    U[k%nsteps]*self()
+                    for rho in rhos:rho()
+                    _prop_stack(U[k%nsteps],rhos)
             # t0,rho0=self.t,copy(self._rho)  #We need to keep the starting state in case this has already been propagated
             
             # Ua=seq.L.Ueye(t0=t0)
@@ -1378,13 +1538,13 @@ class Rho():
                 if axis.lower()=='s':
                     xlabel='t / s'
                 elif axis.lower() in ['microseconds','us']:
-                    x*=1e6
+                    x=x*1e6
                     xlabel=r't / $\mu$s'
                 elif axis.lower()=='ns':
-                    x*=1e9
+                    x=x*1e9
                     xlabel='t / ns'
                 else:
-                    x*=1e3
+                    x=x*1e3
                     xlabel='t / ms'
             else:
                 x=np.arange(len(self.t_axis))
@@ -1535,9 +1695,9 @@ class Rho():
         A=np.zeros([U.L.pwdavg.N,U.shape[0]],dtype=float)
            
         U.eig()
-        for k,(rho0,(d,v)) in enumerate(zip(self._rho,U._eig)):
+        for k,(rho0,(d,v,vi)) in enumerate(zip(self._rho,U._eig)):
             # d,v=np.linalg.eig(U0)
-            rhod=np.linalg.pinv(v)@rho0
+            rhod=vi@rho0
             det_d=self._detect[det_num]@v
             
             A[k]=(rhod*det_d).real  #Amplitude
@@ -1649,4 +1809,195 @@ class Rho():
 
         
             
-        
\ No newline at end of file
+        
+
+def _prop_stack(U,rhos):
+    """
+    Applies the propagator U to several Rho objects (same shape and time). The
+    density matrices are stacked (Npwd,d,n_rho), such that propagation is one
+    matrix-matrix product for each element of the powder average.
+
+    Parameters
+    ----------
+    U : Propagator
+        Propagator applied to all Rho objects.
+    rhos : list
+        List of Rho objects.
+
+    Returns
+    -------
+    None.
+
+    """
+    if len(rhos)==1 or (not(U.calculated) and Defaults['krylov']):
+        for rho in rhos:U*rho
+        return
+    U.calcU()
+    for rho in rhos:rho._prop_setup(U)
+    X=U.U@np.stack([rho._rho for rho in rhos],axis=-1)
+    for k,rho in enumerate(rhos):
+        rho._rho=np.ascontiguousarray(X[...,k])
+        rho._prop_finish(U)
+
+#%% Batches of initial states
+class RhoBatch():
+    def __init__(self,rho0:list,detect,Reduce:bool=True,L=None):
+        """
+        Several initial density matrices with common detection operators,
+        propagated together. Each initial state is stored in a Rho object, 
+        but propagation is performed on the stacked density matrices 
+        (Npwd,d,n_states), such that one matrix-matrix product propagates
+        all states, and propagators, their eigendecompositions, and the
+        state-space reduction are calculated once for the batch. Note that
+        for step-by-step propagation, the states are stacked (copied) and
+        unstacked again at every step.
+        
+        batch=sl.RhoBatch(['13Cx','13Cz','Thermal'],['13Cx','13Cz'])
+        batch.DetProp(seq,n=500)
+        batch.I       #Shape (n_states,Nd,Nt)
+        batch[1].plot()  #Rho object for '13Cz'
+        
+        Several sequences sharing the same Liouvillian (e.g. different 
+        spin-lock strengths) may be applied to copies of the batch, which
+        must not have been propagated yet. This is a convenience only: each
+        sequence is propagated separately, with its own propagators (the
+        propagator cache is keyed by the rf field, so different spin-lock
+        strengths do not share step propagators).
+        
+        batch.DetProp(seq=[seq0,seq1],n=500)
+        batch.I       #Shape (n_seq,n_states,Nd,Nt)
+        batch[1,0]    #Rho object for seq1 and '13Cx'
+
+        Parameters
+        ----------
+        rho0 : list
+            List of initial density matrices (see Rho).
+        detect : Detection matrix or list of matrices (see Rho).
+        Reduce : bool, optional
+            Reduce the size of the Liouvillian (common reduction for all
+            initial states). The default is True.
+        L : Liouvillian, optional
+            The default is None.
+
+        Returns
+        -------
+        None.
+
+        """
+        if not(isinstance(rho0,(list,tuple))):rho0=[rho0]
+        self.rho0=list(rho0)
+        self.detect=detect
+        self.Reduce=Reduce
+        self._L=L
+        self.rhos=[self._new_rhos()]  #Rho objects for each sequence and initial state
+    
+    def _new_rhos(self):
+        return [Rho(rho0,self.detect,Reduce=self.Reduce,L=self._L) for rho0 in self.rho0]
+    
+    @property
+    def n_states(self):
+        return len(self.rho0)
+    
+    @property
+    def n_seq(self):
+        return len(self.rhos)
+    
+    def __len__(self):
+        return self.n_states
+    
+    def __getitem__(self,i):
+        """
+        Returns the Rho object for the ith initial state (batch[i]) or for 
+        the sth sequence and ith initial state (batch[s,i]).
+        """
+        if isinstance(i,tuple):
+            return self.rhos[i[0]][i[1]]
+        assert self.n_seq==1,"Index with batch[s,i] if several sequences have been applied"
+        return self.rhos[0][i]
+    
+    @property
+    def _untouched(self):
+        return all(rho._t is None and rho._nt==0 for rhos in self.rhos for rho in rhos)
+    
+    def Detect(self):
+        for rhos in self.rhos:
+            for rho in rhos:rho.Detect()
+        return self
+    
+    def __call__(self):
+        return self.Detect()
+    
+    def prop(self,U):
+        """
+        Propagates all initial states by the provided propagator or sequence
+        """
+        if hasattr(U,'add_channel'):U=U.U() #Sequence provided
+        for rhos in self.rhos:_prop_stack(U,rhos)
+        return self
+    
+    def __rmul__(self,U):
+        return self.prop(U)
+    
+    def DetProp(self,U=None,seq=None,n:int=5000,n_per_seq:int=1):
+        """
+        Executes a series of propagation/detection steps for all initial 
+        states (see Rho.DetProp). A list of sequences may be provided, in 
+        which case each sequence is applied to its own copy of the initial
+        states.
+
+        Parameters
+        ----------
+        U : Propagator
+            Propagator applied. Should be an integer number of rotor periods
+        seq : Sequence or list of sequences
+             Alternative to providing a propagator
+        n : int, optional
+            Number of time steps. The default is 5000.
+        n_per_seq : int, optional 
+            Allows one to break a sequence into steps, e.g. to obtain a larger
+            spectral width.
+
+        Returns
+        -------
+        self
+
+        """
+        if isinstance(seq,(list,tuple)):
+            if self.n_seq!=len(seq):
+                assert self._untouched,"Several sequences may only be applied to a batch that has not been propagated"
+                self.rhos=[self._new_rhos() for _ in seq]
+            for seq0,rhos in zip(seq,self.rhos):
+                rhos[0].DetProp(seq=seq0,n=n,n_per_seq=n_per_seq,others=rhos[1:])
+        else:
+            for rhos in self.rhos:
+                rhos[0].DetProp(U=U,seq=seq,n=n,n_per_seq=n_per_seq,others=rhos[1:])
+        return self
+    
+    @property
+    def t_axis(self):
+        return self.rhos[0][0].t_axis
+    
+    @property
+    def I(self):
+        """
+        Powder-averaged signals, with shape (n_states,Nd,Nt), or 
+        (n_seq,n_states,Nd,Nt) if several sequences have been applied
+        """
+        I=np.array([[rho.I for rho in rhos] for rhos in self.rhos])
+        return I[0] if self.n_seq==1 else I
+    
+    @property
+    def Ipwd(self):
+        """
+        Signals for each element of the powder average, with shape 
+        (n_states,Npwd,Nd,Nt), or (n_seq,n_states,Npwd,Nd,Nt) if several
+        sequences have been applied
+        """
+        I=np.array([[rho.Ipwd for rho in rhos] for rhos in self.rhos])
+        return I[0] if self.n_seq==1 else I
+    
+    def __repr__(self):
+        out=f'Batch of {self.n_states} initial density matrices'
+        if self.n_seq>1:out+=f', propagated by {self.n_seq} sequences'
+        out+='\nrho0: '+', '.join([f'{r}' if isinstance(r,str) else 'user-defined matrix' for r in self.rho0])
+        return out
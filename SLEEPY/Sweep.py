@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parameter sweeps (Sweep) and memory-mapped storage of their results 
+(ResultStore)
+"""
+
+import numpy as np
+import multiprocessing as mp
+import os
+import warnings
+from time import time
+from . import Defaults
+
+
+class Sweep():
+    def __init__(self,ex,grid:dict,recipe,setup=None,update=None,folder:str='sweep',
+                 filename=None,legacy=None,nprocs:int=None):
+        """
+        Runs a simulation over a grid of parameters, for example, a set of
+        correlation times, spin-diffusion rates, and spin-lock strengths. Grid
+        points are distributed over a pool of processes, where each process
+        takes a new point as soon as it has finished the previous one. Results
+        are written into a single memory-mapped file holding the full grid
+        (see ResultStore), with a mask of completed points, so that an 
+        interrupted sweep resumes from the completed points.
+
+        The Liouvillian is built only once (setup), and the coherent part
+        (rotating components for all elements of the powder average) is
+        calculated before the worker processes are started, so that the
+        workers share it. For each grid point, update then modifies the
+        Liouvillian (usually via L.set_rate) and recipe calculates the result.
+
+        def setup(ex):
+            L=ex.Liouvillian()
+            L.add_SpinEx([1,2],1e-5)
+            L.add_relax('SpinDiffusion',i=1,k=1)
+            return L
+        def update(L,tc,kSD,v1):
+            L.set_rate(0,1/tc).set_rate(1,kSD)
+        def recipe(L,tc,kSD,v1):
+            seq=L.Sequence().add_channel('13C',v1=v1)
+            rho=sl.Rho('13Cx','13Cx')
+            return rho.DetProp(seq,n=500).I[0].real
+
+        sweep=sl.Sweep(ex,grid={'tc':tc0,'kSD':kSD0,'v1':[2000,7000]},
+                       recipe=recipe,setup=setup,update=update,folder='T1p')
+        sweep.run()
+        I=sweep.results   #Shape: (len(tc0),len(kSD0),2,500)
+
+        Parameters
+        ----------
+        ex : ExpSys or function
+            Experimental system, or function returning the experimental system
+            (called once).
+        grid : dict
+            Parameter names and values to sweep over. The full grid is the
+            outer product of all values.
+        recipe : function
+            Called as recipe(L,**point) for each grid point. Should return the
+            result (np.array, same shape for all points). If None is returned
+            (e.g. the calculation failed), the point is not stored, and is
+            attempted again by the next run.
+        setup : function, optional
+            Called as setup(ex), returning the Liouvillian. The default is None,
+            which simply uses ex.Liouvillian()
+        update : function, optional
+            Called as update(L,**point) before recipe, to apply the grid point
+            to the Liouvillian. The default is None.
+        folder : str, optional
+            Folder for storing results. The default is 'sweep'.
+        filename : function, optional
+            If provided, results are instead stored in one file per grid point.
+            Called as filename(index,**point), where index is the index of
+            the point in the grid (tuple), returning the name of the file for
+            that grid point. The default is None (results in a ResultStore)
+        legacy : function, optional
+            Results of earlier runs stored in other files (e.g. one file per
+            grid point from an older version of the script). Called as 
+            legacy(index,**point), returning the result for that point, or 
+            None if not available. Available results are copied into the 
+            ResultStore before calculating (see import_legacy). The default
+            is None.
+        nprocs : int, optional
+            Number of processes. The default is None, which uses
+            Defaults['ncores'] or else the number of cpus
+
+        Returns
+        -------
+        None.
+
+        """
+        self.ex=ex
+        self.grid={key:np.atleast_1d(value) for key,value in grid.items()}
+        self.recipe=recipe
+        self.setup=setup
+        self.update=update
+        self.folder=folder
+        self._filename=filename
+        self.legacy=legacy
+        self._nprocs=nprocs
+        self._L=None
+        self._store=None
+
+    @property
+    def shape(self):
+        return tuple(len(value) for value in self.grid.values())
+
+    def __len__(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nprocs(self):
+        if self._nprocs is not None:return self._nprocs
+        if isinstance(Defaults['ncores'],int):return Defaults['ncores']
+        return mp.cpu_count()
+
+    def index(self,i:int):
+        """
+        Returns the index in the grid (tuple) for the ith point
+        """
+        return tuple(int(i0) for i0 in np.unravel_index(i,self.shape))
+
+    def point(self,i:int):
+        """
+        Returns the parameters for the ith point of the grid as a dictionary
+        """
+        return {key:value[i0] for (key,value),i0 in zip(self.grid.items(),self.index(i))}
+
+    def filename(self,i:int):
+        """
+        Returns the full path of the file storing the ith point of the grid
+        (only if filename was provided)
+        """
+        return os.path.join(self.folder,self._filename(self.index(i),**self.point(i)))
+
+    @property
+    def store(self):
+        """
+        ResultStore holding the results (None if not yet created, or if
+        results are stored in one file per point)
+        """
+        if self._filename is None and ResultStore.exists(self.folder):
+            if self._store is None:
+                self._store=ResultStore(self.folder)
+                assert self._store.grid_shape==self.shape,f'Results in {self.folder} do not match the grid of this sweep'
+            return self._store
+
+    @property
+    def done(self):
+        """
+        Logical array (grid shape) indicating which points have been calculated
+        """
+        if self._filename is None:
+            return np.zeros(self.shape,dtype=bool) if self.store is None else np.array(self.store.done)
+        return np.array([os.path.exists(self.filename(i)) for i in range(len(self))],dtype=bool).reshape(self.shape)
+
+    @property
+    def L(self):
+        """
+        Liouvillian used for the sweep. Built once, with the coherent part
+        pre-calculated for all elements of the powder average (if it fits
+        in Defaults['cache_bytes'])
+        """
+        if self._L is None:
+            ex=self.ex() if callable(self.ex) else self.ex
+            self._L=ex.Liouvillian() if self.setup is None else self.setup(ex)
+            if self._L._cache_Ln_H and not(Defaults['sparse']):
+                for k in range(len(self._L)):self._L[k]._Ln_H_all()
+        return self._L
+
+    def calc(self,i:int):
+        """
+        Calculates and stores the ith point of the grid. Returns i, or None if
+        recipe returned None (nothing stored)
+        """
+        point=self.point(i)
+        if self.update is not None:self.update(self.L,**point)
+        out=self.recipe(self.L,**point)
+        if out is None:return None
+        self._save(i,np.asarray(out))
+        return i
+    
+    def _save(self,i:int,out):
+        """
+        Stores the result (out) for the ith point of the grid
+        """
+        if self._filename is None:
+            if self.store is None:
+                self._store=ResultStore(self.folder,self.shape,out.shape,
+                                        dtype=Defaults['ctype'] if np.iscomplexobj(out) else Defaults['rtype'])
+            self.store[self.index(i)]=out
+        else:
+            file=self.filename(i)
+            np.save(file+'.tmp.npy',out,allow_pickle=False)
+            os.replace(file+'.tmp.npy',file)   #Incomplete files are never mistaken for results
+    
+    def import_legacy(self):
+        """
+        Copies results of earlier runs (see legacy) into storage for all grid
+        points that have not yet been calculated. Called by run.
+        
+        Returns the number of imported points
+        """
+        if self.legacy is None:return 0
+        count=0
+        for i in np.argwhere(np.logical_not(self.done.reshape(-1)))[:,0]:
+            out=self.legacy(self.index(i),**self.point(i))
+            if out is None:continue
+            self._save(i,np.asarray(out))
+            count+=1
+        return count
+
+    def run(self,verbose:bool=True):
+        """
+        Calculates all grid points that are not yet stored in the folder.
+
+        Uses a pool of nprocs processes if nprocs>1 (requires the fork start
+        method, since the Liouvillian and recipe are inherited by the workers).
+        Inside the workers, Defaults['parallel'] is set to False.
+
+        Parameters
+        ----------
+        verbose : bool, optional
+            Print progress of the sweep. The default is True.
+
+        Returns
+        -------
+        self
+
+        """
+        if not(os.path.exists(self.folder)):os.makedirs(self.folder)
+        nlegacy=self.import_legacy()
+        if verbose and nlegacy:print(f'{nlegacy} points imported from earlier runs')
+        todo=np.argwhere(np.logical_not(self.done.reshape(-1)))[:,0].tolist()
+        if len(todo)==0:return self
+
+        self.L  #Build before starting the workers, so that the setup is shared
+        
+        t0=time()
+        n0=0
+        failed=0
+        total=len(todo)
+        while self._filename is None and self.store is None and len(todo):
+            failed+=self.calc(todo.pop(0)) is None  #First stored point determines the shape of the results
+            n0+=1
+            self._progress(n0,total,t0,verbose)
+
+        nprocs=min(self.nprocs,len(todo))
+        if nprocs>1 and 'fork' not in mp.get_all_start_methods():
+            warnings.warn('Parallel sweep requires the fork start method. Running serially')
+            nprocs=1
+
+        global _sweep
+        _sweep=self
+        if nprocs>1:
+            with mp.get_context('fork').Pool(nprocs,initializer=_init_worker) as pool:
+                for counter,i in enumerate(pool.imap_unordered(_calc,todo,chunksize=1)):
+                    failed+=i is None
+                    self._progress(n0+counter+1,total,t0,verbose)
+        else:
+            for counter,i in enumerate(todo):
+                failed+=self.calc(i) is None
+                self._progress(n0+counter+1,total,t0,verbose)
+        _sweep=None
+        if failed:warnings.warn(f'{failed} points not stored (recipe returned None). These are attempted again by the next run')
+        return self
+
+    def _progress(self,counter,total,t0,verbose):
+        if verbose:
+            elapsed=(time()-t0)/60
+            print(f'{counter} of {total} points: {elapsed:.2f} minutes out of ~{elapsed*total/counter:.2f} minutes')
+
+    @property
+    def results(self):
+        """
+        Stored results for the full grid, with shape grid shape + result shape.
+        
+        For a ResultStore, this is the memory-mapped array itself (read-only,
+        not copied), where points not yet calculated are zero (see done). 
+        Otherwise, results are loaded from the individual files, and points
+        not yet calculated are filled with nan
+        """
+        if self._filename is None:
+            return None if self.store is None else self.store.data
+        
+        done=self.done.reshape(-1)
+        if not(np.any(done)):return None
+        out=None
+        for i in np.argwhere(done)[:,0]:
+            x=np.load(self.filename(i),allow_pickle=False)
+            if out is None:
+                out=np.full([len(self),*x.shape],np.nan,dtype=x.dtype if np.iscomplexobj(x) else float)
+            out[i]=x
+        return out.reshape([*self.shape,*out.shape[1:]])
+
+    def __repr__(self):
+        out='Parameter sweep with grid:\n'
+        for key,value in self.grid.items():
+            out+=f'\t{key}: {len(value)} values from {value[0]:.3g} to {value[-1]:.3g}\n'
+        out+=f'{self.done.sum()} of {len(self)} points calculated (folder: {self.folder})\n'
+        return out+'\n'+super().__repr__()
+
+
+#%% Memory-mapped results
+class ResultStore():
+    def __init__(self,folder:str,grid_shape:tuple=None,shape:tuple=None,dtype=float):
+        """
+        Stores the results of a sweep over a grid of parameters in a single,
+        preallocated, memory-mapped file (results.npy, shape grid_shape+shape),
+        along with a mask of the completed grid points (done.npy). Multiple 
+        processes may write different grid points concurrently. 
+        
+        Results are written before the mask is set, such that an interrupted
+        write does not leave invalid entries.
+        
+        Provide grid_shape and shape to create the store (if it does not 
+        already exist). Otherwise, the existing store is opened.
+        
+        store=ResultStore('T1p_5spin_run1')
+        I=store.data       #(ntc,nSD,nv1,nt), memory-mapped
+        done=store.done    #(ntc,nSD,nv1)
+
+        Parameters
+        ----------
+        folder : str
+            Folder containing the results.
+        grid_shape : tuple, optional
+            Shape of the parameter grid. The default is None.
+        shape : tuple, optional
+            Shape of the result for each grid point. The default is None.
+        dtype : optional
+            Data type of the results. The default is float.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.folder=folder
+        if not(self.exists(folder)):
+            assert grid_shape is not None and shape is not None,f'No results found in {folder}: grid_shape and shape required'
+            os.makedirs(folder,exist_ok=True)
+            for name,shape0,dtype0 in [('results.npy',(*grid_shape,*shape),dtype),('done.npy',grid_shape,bool)]:
+                tmp=os.path.join(folder,f'{name}.{os.getpid()}.tmp')  #Create under temporary name, then move into place
+                np.lib.format.open_memmap(tmp,mode='w+',dtype=dtype0,shape=tuple(int(s) for s in shape0)).flush()
+                os.replace(tmp,os.path.join(folder,name))
+        self._data=np.lib.format.open_memmap(os.path.join(folder,'results.npy'),mode='r+')
+        self._done=np.lib.format.open_memmap(os.path.join(folder,'done.npy'),mode='r+')
+        assert self._data.shape[:self._done.ndim]==self._done.shape,f'Results and mask in {folder} do not match'
+        if grid_shape is not None:
+            assert self.grid_shape==tuple(grid_shape),f'Results in {folder} do not match the requested grid'
+    
+    @staticmethod
+    def exists(folder:str):
+        """
+        Returns True if a ResultStore exists in folder
+        """
+        return os.path.exists(os.path.join(folder,'results.npy')) and os.path.exists(os.path.join(folder,'done.npy'))
+    
+    @property
+    def grid_shape(self):
+        return self._done.shape
+    
+    @property
+    def shape(self):
+        return self._data.shape[self._done.ndim:]
+    
+    @property
+    def data(self):
+        """
+        Read-only view of the full memory-mapped results
+        """
+        out=self._data.view()
+        out.flags.writeable=False
+        return out
+    
+    @property
+    def done(self):
+        """
+        Read-only view of the mask of completed grid points
+        """
+        out=self._done.view()
+        out.flags.writeable=False
+        return out
+    
+    def __getitem__(self,index):
+        return self.data[index]
+    
+    def __setitem__(self,index,value):
+        self._data[index]=value
+        self._data.flush()
+        self._done[index]=True
+        self._done.flush()
+    
+    def __repr__(self):
+        out=f'Result store in {self.folder}\n'
+        out+=f'Grid shape: {self.grid_shape}, result shape: {self.shape}, dtype: {self._data.dtype}\n'
+        out+=f'{self._done.sum()} of {self._done.size} points completed\n'
+        return out+'\n'+super().__repr__()
+
+
+#%% Worker functions
+_sweep=None
+
+def _init_worker():
+    Defaults['parallel']=False   #Pool workers cannot start their own worker processes
+
+def _calc(i):
+    return _sweep.calc(i)
@@ -8,6 +8,8 @@ Created on Fri Nov  8 13:44:13 2019
 
 import os
 import numpy as np
+import scipy.sparse as sps
+from scipy.sparse.csgraph import connected_components
 from copy import copy
 import re
 from .Info import Info
@@ -252,7 +254,7 @@ def D2(ca=0,sa=0,cb=0,sb=None,cg=None,sg=None,m=None,mp=0):
         
     return (d2(cb,sb,m,mp)*phase).T
 
-def Ham2Super(H):
+def Ham2Super(H,sparse:bool=False,factored:bool=False):
     """
     Calculates
     kron(H,eye(H.shape))-kron(eye(H.shape),H.T), while avoiding actually
@@ -262,6 +264,10 @@ def Ham2Super(H):
     ----------
     H : np.array
         Hamiltonian.
+    sparse : bool, optional
+        Return a sparse (CSR) matrix. The default is False.
+    factored : bool, optional
+        Return a Kronecker-factored SuperOp. The default is False.
 
     Returns
     -------
@@ -269,14 +275,17 @@ def Ham2Super(H):
 
     """
     n=H.shape[0]
-    Lp=np.zeros([n**2,n**2],dtype=H.dtype)
-    Lm=np.zeros([n**2,n**2],dtype=H.dtype)
-    for k in range(n):
-        Lp[k::n][:,k::n]=H
-        Lm[k*n:(k+1)*n][:,k*n:(k+1)*n]=H.T
-    return Lp-Lm
-
-def LeftSuper(X):
+    if factored:
+        I=np.eye(n,dtype=H.dtype)
+        return SuperOp([(H,I),(I,-H.T)])
+    if sparse:
+        H=sps.csr_matrix(H)
+        I=sps.identity(n,dtype=H.dtype,format='csr')
+        return (sps.kron(H,I,format='csr')-sps.kron(I,H.T,format='csr')).tocsr()
+    I=np.eye(n,dtype=H.dtype)
+    return np.kron(H,I)-np.kron(I,H.T)
+
+def LeftSuper(X,sparse:bool=False,factored:bool=False):
     """
     Returns the super operator in Liouville spacefor square matrix X that 
     yields left multiplication in the Hilbert space
@@ -288,6 +297,10 @@ def LeftSuper(X):
     ----------
     X : np.array
         Square matrix (nxn)
+    sparse : bool, optional
+        Return a sparse (CSR) matrix. The default is False.
+    factored : bool, optional
+        Return a Kronecker-factored SuperOp. The default is False.
 
     Returns
     -------
@@ -295,13 +308,13 @@ def LeftSuper(X):
         Superoperator (n**2xn**2)
 
     """
-    n=X.shape[0]
-    Super=np.zeros([n**2,n**2],dtype=X.dtype)
-    for k in range(n):
-        Super[k::n][:,k::n]=X
-    return Super
+    if factored:
+        return SuperOp([(X,np.eye(X.shape[0],dtype=X.dtype))])
+    if sparse:
+        return sps.kron(sps.csr_matrix(X),sps.identity(X.shape[0],dtype=X.dtype),format='csr')
+    return np.kron(X,np.eye(X.shape[0],dtype=X.dtype))
 
-def RightSuper(X):
+def RightSuper(X,sparse:bool=False,factored:bool=False):
     """
     Returns the super operator in Liouville spacefor square matrix X that 
     yields right multiplication in the Hilbert space
@@ -313,6 +326,10 @@ def RightSuper(X):
     ----------
     X : np.array
         Square matrix (nxn)
+    sparse : bool, optional
+        Return a sparse (CSR) matrix. The default is False.
+    factored : bool, optional
+        Return a Kronecker-factored SuperOp. The default is False.
 
     Returns
     -------
@@ -320,48 +337,159 @@ def RightSuper(X):
         Superoperator (n**2xn**2)
 
     """
-    n=X.shape[0]
-    Super=np.zeros([n**2,n**2],dtype=X.dtype)
-    for k in range(n):
-        Super[k*n:(k+1)*n][:,k*n:(k+1)*n]=X.T
-    return Super
+    if factored:
+        return SuperOp([(np.eye(X.shape[0],dtype=X.dtype),X.T)])
+    if sparse:
+        return sps.kron(sps.identity(X.shape[0],dtype=X.dtype),sps.csr_matrix(X.T),format='csr')
+    return np.kron(np.eye(X.shape[0],dtype=X.dtype),X.T)
+
+class SuperOp():
+    def __init__(self,terms:list):
+        """
+        Superoperator stored in Kronecker-factored form, i.e. as a sum of 
+        terms kron(A,B), where A and B are Hilbert-space (nxn) matrices. 
+        Products and sums of superoperators are evaluated on the factors,
+        (kron(A,B)@kron(C,D)=kron(A@C,B@D)), such that the dense (n**2xn**2)
+        matrix is only formed when requested (SuperOp.dense()).
+        
+        Obtained from Ham2Super, LeftSuper, and RightSuper with factored=True
+        
+        Parameters
+        ----------
+        terms : list
+            List of tuples (A,B).
+
+        Returns
+        -------
+        None.
+
+        """
+        self.terms=[]
+        for A,B in terms:  #Combine terms with a common factor
+            for k,(A0,B0) in enumerate(self.terms):
+                if A0.shape==A.shape and np.array_equal(A0,A):
+                    self.terms[k]=(A0,B0+B)
+                    break
+                if B0.shape==B.shape and np.array_equal(B0,B):
+                    self.terms[k]=(A0+A,B0)
+                    break
+            else:
+                self.terms.append((A,B))
+    
+    @property
+    def shape(self):
+        A,B=self.terms[0]
+        return (A.shape[0]*B.shape[0],A.shape[1]*B.shape[1])
+    
+    @property
+    def dtype(self):
+        return np.result_type(*[x for AB in self.terms for x in AB])
+    
+    def dense(self):
+        """
+        Returns the superoperator as a dense numpy array
+        """
+        return np.sum([np.kron(A,B) for A,B in self.terms],axis=0)
+    
+    def __array__(self,dtype=None,copy=None):
+        out=self.dense()
+        return out if dtype is None else out.astype(dtype)
+    
+    def __matmul__(self,X):
+        if isinstance(X,SuperOp):
+            return SuperOp([(A@C,B@D) for A,B in self.terms for C,D in X.terms])
+        if X.ndim==1:  #kron(A,B)@x=(A@x.reshape(n,n)@B.T).reshape(n**2)
+            n=(self.terms[0][0].shape[1],self.terms[0][1].shape[1])
+            x=X.reshape(n)
+            return np.sum([A@x@B.T for A,B in self.terms],axis=0).reshape(X.shape)
+        return self.dense()@X
     
+    def __rmatmul__(self,X):
+        return X@self.dense()
+    
+    def __add__(self,X):
+        if isinstance(X,SuperOp):
+            return SuperOp([*self.terms,*X.terms])
+        return self.dense()+X
+    
+    def __radd__(self,X):
+        return self.__add__(X)
+    
+    def __neg__(self):
+        return SuperOp([(-A,B) for A,B in self.terms])
+    
+    def __sub__(self,X):
+        return self+(-X)
+    
+    def __rsub__(self,X):
+        return (-self)+X
+    
+    def __mul__(self,a):
+        assert np.isscalar(a),"SuperOp may only be multiplied by scalars (use @ for matrix products)"
+        return SuperOp([(a*A,B) for A,B in self.terms])
+    
+    def __rmul__(self,a):
+        return self.__mul__(a)
+
+def phase_table(n_gamma:int):
+    """
+    Phases applied to the rotating components of the Liouvillian (m=-2..2)
+    for each step of the rotor period, with shape (n_gamma,5). The Liouvillian
+    for step n is then obtained from the rotating components, Ln (5,d,d), as
+    
+    np.tensordot(phase_table(n_gamma)[n%n_gamma],Ln,axes=1)
+
+    Parameters
+    ----------
+    n_gamma : int
+        Number of steps in the rotor period.
+
+    Returns
+    -------
+    np.array
+
+    """
+    if n_gamma not in _phase_table:
+        out=np.exp(-1j*2*np.pi*np.outer(np.arange(n_gamma),np.arange(-2,3))/n_gamma)
+        out.flags.writeable=False
+        _phase_table[n_gamma]=out
+    return _phase_table[n_gamma]
+_phase_table={}
+
+def dense(X):
+    """
+    Returns X as a numpy array if X is a sparse matrix (otherwise X itself)
+    """
+    return X.toarray() if sps.issparse(X) else X
     
 def BlockDiagonal(M):
     """
     Determines connectivity of a matrix, allowing us to represent a large
     matrix as several smaller matrices. Speeds up matrix exponential, matrix
     multiplication
+    
+    Blocks are the connected components of the graph defined by the non-zero
+    elements of M (sparse search, scipy.sparse.csgraph), ordered by their
+    first index.
 
     Parameters
     ----------
-    M : TYPE
-        DESCRIPTION.
+    M : np.array or sparse matrix
+        Square matrix (only the non-zero pattern is used).
 
     Returns
     -------
-    None.
+    list
+        Logical index for each block.
 
     """
     
     assert M.shape[0]==M.shape[1],'Matrix should be square for BlockDiagonal calculation'
+    X=sps.csr_matrix(M).astype(bool)
     
-    X=M.astype(bool)+M.astype(bool).T
-    
-    Blks=list()
-    unchecked=np.ones(X.shape[0],dtype=bool)
-
-    while np.any(unchecked):
-        bl=np.zeros(X.shape[0],dtype=bool)
-        bl[np.argwhere(unchecked)[0,0]]=True
-        while np.any(np.logical_and(bl,unchecked)):
-            i=np.argwhere(np.logical_and(unchecked,bl))[0,0]
-            unchecked[i]=False
-            m=np.logical_and(X[i],unchecked)
-            bl[m]=True
-        Blks.append(bl)
-    
-    return Blks
+    n,labels=connected_components(X,directed=True,connection='weak')
+    first=np.unique(labels,return_index=True)[1]  #Order blocks by their first index
+    return [labels==labels[i] for i in np.sort(first)]
             
 
 def twoSite_kex(tc:float,p1:float=0.5):
@@ -711,4 +839,202 @@ def commute(A,B):
     
     
     
-       
\ No newline at end of file
+       
+#%% Batched matrix exponential
+_pade={3:[120.,60.,12.,1.],
+       5:[30240.,15120.,3360.,420.,30.,1.],
+       7:[17297280.,8648640.,1995840.,277200.,25200.,1512.,56.,1.],
+       9:[17643225600.,8821612800.,2075673600.,302702400.,30270240.,
+          2162160.,110880.,3960.,90.,1.],
+       13:[64764752532480000.,32382376266240000.,7771770303897600.,
+           1187353796428800.,129060195264000.,10559470521600.,670442572800.,
+           33522128640.,1323241920.,40840800.,960960.,16380.,182.,1.]}
+_theta={3:1.495585217958292e-2,5:2.539398330063230e-1,7:9.504178996162932e-1,
+        9:2.097847961257068,13:5.371920351148152}
+
+def expm_batch(A):
+    """
+    Matrix exponential of a stack of square matrices (shape ...xnxn), using
+    the scaling-and-squaring Padé approximation (Higham, SIAM J. Matrix Anal.
+    Appl. 2005, 26, 1179). All matrices in the stack are exponentiated 
+    together, such that the cost of python/scipy calls is paid once per stack
+    rather than once per matrix.
+    
+    The Padé order is selected based on the largest 1-norm in the stack. For
+    order 13, scaling is determined separately for each matrix.
+
+    Parameters
+    ----------
+    A : np.array
+        Stack of square matrices (...,n,n)
+
+    Returns
+    -------
+    np.array
+        exp(A) for each matrix in the stack
+
+    """
+    A=np.asarray(A)
+    shape=A.shape
+    A=A.reshape(-1,*shape[-2:])
+    if A.shape[0]==0:return A.reshape(shape)
+    
+    norm=np.abs(A).sum(-2).max(-1)
+    eye=np.eye(shape[-1],dtype=A.dtype)
+    
+    for m in [3,5,7,9]:
+        if norm.max()<=_theta[m]:
+            s=np.zeros(len(A),dtype=int)
+            break
+    else:
+        m=13
+        s=np.maximum(0,np.ceil(np.log2(norm/_theta[13]))).astype(int)
+        A=A*(2.**-s)[:,None,None]
+    
+    b=_pade[m]
+    A2=A@A
+    if m==13:
+        A4=A2@A2
+        A6=A4@A2
+        U=A@(A6@(b[13]*A6+b[11]*A4+b[9]*A2)+b[7]*A6+b[5]*A4+b[3]*A2+b[1]*eye)
+        V=A6@(b[12]*A6+b[10]*A4+b[8]*A2)+b[6]*A6+b[4]*A4+b[2]*A2+b[0]*eye
+    else:
+        U=b[1]*eye+b[3]*A2
+        V=b[0]*eye+b[2]*A2
+        A2k=A2
+        for k in range(2,m//2+1):  #Even powers of A
+            A2k=A2k@A2
+            U=U+b[2*k+1]*A2k
+            V=V+b[2*k]*A2k
+        U=A@U
+    
+    R=np.linalg.solve(V-U,V+U)
+    
+    for k in range(s.max()):  #Squaring (only for matrices that were scaled)
+        i=s>k
+        R[i]=R[i]@R[i]
+        
+    return R.reshape(shape)
+
+def prod_tree(U,partial:bool=False):
+    """
+    Product of a stack of matrices, applied in order (U[-1]@...@U[1]@U[0]).
+    The product is evaluated by pairwise (tree) reduction, such that each
+    level of the tree is a single batched matrix multiplication.
+    
+    Setting partial to True returns all partial products from step k to the
+    end of the stack, i.e. out[k]=U[-1]@...@U[k] (out[0] is the full product).
+    These are obtained with log2(n) batched multiplications (parallel prefix).
+    
+    Additional leading dimensions after the first (e.g. the powder average)
+    are broadcast.
+
+    Parameters
+    ----------
+    U : np.array or list
+        Stack of square matrices (n,...,d,d)
+    partial : bool, optional
+        Return the partial products. The default is False.
+
+    Returns
+    -------
+    np.array
+
+    """
+    U=np.asarray(U)
+    
+    if partial:
+        S=U.copy()
+        n,s=len(S),1
+        while s<n:
+            S[:n-s]=S[s:]@S[:n-s]
+            s*=2
+        return S
+    
+    while len(U)>1:
+        odd=len(U)%2
+        U0=U[1:len(U)-odd:2]@U[0:len(U)-odd:2]
+        U=np.concatenate((U0,U[-1:]),axis=0) if odd else U0
+    return U[0]
+
+def inv_batch(v,cond_max:float=1e12):
+    """
+    Inverse of a stack of matrices (...,d,d), e.g. the eigenvectors of the
+    propagators for all elements of the powder average, obtained with one
+    batched solve. Elements that are singular or ill-conditioned (e.g. nearly
+    defective eigenbases for exchange near coalescence) fall back to the 
+    pseudo-inverse. The condition number is estimated from the 1-norms of the
+    matrix and its inverse.
+
+    Parameters
+    ----------
+    v : np.array
+        Stack of square matrices (...,d,d).
+    cond_max : float, optional
+        Elements with a larger (estimated) condition number use the 
+        pseudo-inverse. The default is 1e12.
+
+    Returns
+    -------
+    np.array
+
+    """
+    v=np.asarray(v)
+    eye=np.broadcast_to(np.eye(v.shape[-1],dtype=v.dtype),v.shape)
+    try:
+        out=np.linalg.solve(v,eye)
+    except np.linalg.LinAlgError:
+        out=np.zeros(v.shape,dtype=v.dtype)
+        for i in np.ndindex(v.shape[:-2]):
+            try:
+                out[i]=np.linalg.solve(v[i],eye[i])
+            except np.linalg.LinAlgError:
+                out[i]=np.nan
+    with np.errstate(invalid='ignore',over='ignore'):
+        cond=np.abs(v).sum(-2).max(-1)*np.abs(out).sum(-2).max(-1)
+    for i in np.ndindex(v.shape[:-2]):
+        if not(cond[i]<=cond_max):out[i]=np.linalg.pinv(v[i])  #Also catches nan (singular)
+    return out
+
+def eig_signal(d,A,n:int,start:int=0):
+    """
+    Detected signal in the eigenbasis of a propagator, without forming the
+    density matrix at each time point:
+        
+        I[...,m,j]=sum_i A[...,m,i]*d[...,i]**(start+j),  j=0...n-1
+        
+    where A=(det@v)*(vi@rho0) for eigenvalues d and eigenvectors v of the
+    propagator. The Vandermonde matrix (d**j) is generated in chunks of time
+    points (about 4 MB) and contracted with A as one batched product, such 
+    that memory is independent of n.
+
+    Parameters
+    ----------
+    d : np.array
+        Eigenvalues (N,d), where N is the number of elements of the powder
+        average.
+    A : np.array
+        Detection and initial state in the eigenbasis (N,n_det,d).
+    n : int
+        Number of time points.
+    start : int, optional
+        Power of the first time point. The default is 0.
+
+    Returns
+    -------
+    np.array
+        Signal (N,n_det,n)
+
+    """
+    d,A=np.asarray(d),np.asarray(A)
+    out=np.zeros([*A.shape[:-1],n],dtype=np.result_type(d,A))
+    if n==0:return out
+    c=int(np.clip(2**18//d.size,1,n))  #Time points per chunk
+    
+    V=d[:,:,None]**np.arange(start,start+c)   #(N,d,c)
+    dc=d[:,:,None]**c
+    for j0 in range(0,n,c):
+        j1=min(j0+c,n)
+        out[...,j0:j1]=A@V[...,:j1-j0]
+        V*=dc
+    return out
@@ -4,7 +4,12 @@
 Defaults={}
 from numpy import float64 as _rtype       #Not much gain if we reduced precision.
 from numpy import complex128 as _ctype    #Also, overflow errors become common at lower precision
-Defaults.update({'rtype':_rtype,'ctype':_ctype,'parallel':False,'cache':True,'ncores':None,'verbose':True})
+Defaults.update({'rtype':_rtype,'ctype':_ctype,'parallel':False,'cache':True,'ncores':None,'verbose':True,
+                 'batch_bytes':2**27,    #Approximate memory (bytes) of stacked matrices exponentiated together
+                 'cache_dir':None,       #Folder for storing step propagators on disk (None: memory only)
+                 'cache_bytes':2**33,    #Memory budget for stored propagators, shared by all Liouvillians and blocks (least recently used fields are removed first)
+                 'krylov':False,         #Apply sequences to rho step-by-step (expm_multiply) without calculating propagators (saves memory, much slower)
+                 'sparse':False})        #Store the Liouvillian (Ln, Lrf, Lex, Lrelax) as sparse (CSR) matrices (propagators then calculated serially)
 
 Constants={'h':6.62607015e-34,'kB':1.380649e-23,'mub':-9.2740100783e-24/6.62607015e-34,'ge':2.0023193043609236}
 
@@ -15,8 +20,9 @@ from .ExpSys import ExpSys
 from .Hamiltonian import Hamiltonian
 from .Liouvillian import Liouvillian
 from .Sequence import Sequence
-from .Rho import Rho
+from .Rho import Rho,RhoBatch
 from .LFrf import LFrf
+from .Sweep import Sweep,ResultStore
 
 
 
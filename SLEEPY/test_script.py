@@ -302,3 +302,380 @@ rhoHz=sl.Rho(rho0='1Hz',detect='1Hz')
 (U*rhoHz)()
 print(rhoHz.I)
 
+
+#%% Checks: batched, cached, and sparse calculations vs. direct calculation
+# Each cell below checks one of the performance features against a direct
+# (unbatched, uncached, or dense) calculation. Run this cell first.
+import os
+import tempfile
+import warnings
+from copy import copy
+from scipy.linalg import expm
+import SLEEPY as sl
+import numpy as np
+
+sl.Defaults['verbose']=False
+Defaults0=copy(sl.Defaults)
+
+def reset_defaults():
+    sl.Defaults.update(Defaults0)
+
+def build_L(q:int=1,n_gamma:int=10,OS:bool=False,exchange:bool=False):
+    ex=sl.ExpSys(v0H=400,Nucs=['13C','1H'],vr=10000,pwdavg=sl.PowderAvg(q=q),n_gamma=n_gamma,T_K=50 if OS else None)
+    ex.set_inter('dipole',i0=0,i1=1,delta=20000)
+    ex.set_inter('CSA',i=0,delta=50)
+    if exchange:
+        ex1=ex.copy()
+        ex1.set_inter('dipole',i0=0,i1=1,delta=20000,euler=[0,np.pi/4,0])
+        L=sl.Liouvillian(ex,ex1,kex=sl.Tools.twoSite_kex(tc=1e-5))
+    else:
+        L=ex.Liouvillian()
+    L.add_relax('T2',i=0,T2=.01)
+    if OS:
+        L.add_relax('T1',i=1,T1=.1,OS=True,Thermal=True)
+        L.add_relax('T2',i=1,T2=.01,OS=True)
+    return L
+
+def build_ex(kSD:float=10):
+    L=build_L(exchange=True)
+    L.add_relax('SpinDiffusion',i=1,k=kSD)
+    return L
+
+def R1p(L,v1:float=20000,n:int=150):
+    seq=L.Sequence().add_channel('13C',v1=v1)
+    return sl.Rho('13Cx','13Cx').DetProp(seq,n=n).I[0]
+
+#%% user-024 Batched initial states (RhoBatch) vs. individual Rho
+reset_defaults()
+L=build_L(exchange=True)
+seq=L.Sequence().add_channel('13C',v1=20000)
+batch=sl.RhoBatch(['13Cx','13Cy','13Cz'],['13Cx','13Cz'])
+batch.DetProp(seq,n=150)
+for k,rho0 in enumerate(['13Cx','13Cy','13Cz']):
+    rho=sl.Rho(rho0,['13Cx','13Cz'])
+    rho.DetProp(seq,n=150)
+    assert np.abs(batch.I[k]-rho.I).max()<1e-12
+
+#%% user-001 Batched expm of the step propagators (Para.prop_batch)
+reset_defaults()
+A=np.random.randn(7,6,6)*3+1j*np.random.randn(7,6,6)
+U=np.array([expm(A0) for A0 in A])
+assert np.abs(sl.Tools.expm_batch(A)-U).max()<1e-12*np.abs(U).max()
+
+U=[]
+for cache in [True,False]:
+    for batch_bytes in [2**27,2**10]:  #Small stacks: flushed within each element
+        sl.Defaults['cache'],sl.Defaults['batch_bytes']=cache,batch_bytes
+        L=build_L(q=2,n_gamma=30)
+        U.append(L.U(Dt=L.taur*2.3,calc_now=True).U)
+assert max([np.abs(U0-U[0]).max() for U0 in U])<1e-12
+
+#%% user-002 Tree product of the step propagators
+reset_defaults()
+U=np.random.randn(9,3,4,4)
+U0=U[0]
+for U1 in U[1:]:U0=U1@U0
+assert np.abs(sl.Tools.prod_tree(U)-U0).max()<1e-10*np.abs(U0).max()
+S=sl.Tools.prod_tree(U,partial=True)  #S[k]=U[-1]@...@U[k]
+for k in range(len(U)):
+    assert np.abs(S[k]-sl.Tools.prod_tree(U[k:])).max()<1e-10*np.abs(U0).max()
+L=build_L()
+seq=L.Sequence(Dt=L.taur/3).add_channel('13C',v1=20000)
+I0=sl.Rho('13Cx','13Cx').DetProp(seq,n=600).I[0]   #Eigenvalue route, rotor periods from partial products
+rho=sl.Rho('13Cx','13Cx')
+U=[seq.U(Dt=L.taur/3,t0_seq=k*L.taur/3) for k in range(3)]
+for k in range(600):U[k%3]*rho()
+assert np.abs(I0-rho.I[0]).max()<1e-10
+
+#%% user-003 On-disk propagator cache (second Liouvillian loads from disk)
+reset_defaults()
+with tempfile.TemporaryDirectory() as folder:
+    sl.Defaults['cache_dir']=folder
+    I0=R1p(build_L())
+    assert len(os.listdir(folder))
+    I1=R1p(build_L())   #New Liouvillian, same content
+sl.Defaults['cache_dir']=None
+assert np.abs(I0-I1).max()<1e-12
+assert np.abs(I0-R1p(build_L())).max()<1e-12
+
+#%% user-004 Memory budget for the propagator cache
+reset_defaults()
+I0=[R1p(build_L(),v1=v1) for v1 in [5000,10000,20000]]
+sl.Defaults['cache_bytes']=2**17
+L,L1=build_L(),build_ex()
+I1=[]
+for v1 in [5000,10000,20000]:
+    I1.append(R1p(L,v1=v1))
+    R1p(L1,v1=v1)
+    assert sum(PC.nbytes for PC in sl.Propagator._caches)<=2**17  #Budget shared by all caches
+assert max([np.abs(a-b).max() for a,b in zip(I0,I1)])<1e-12
+
+#%% user-005 Persistent worker pool
+reset_defaults()
+I0=R1p(build_L(q=2))
+sl.Defaults['parallel'],sl.Defaults['ncores']=True,2
+I1=R1p(build_L(q=2))
+pool=sl.Para._pool
+I2=R1p(build_L(q=2))
+assert sl.Para._pool is pool and pool.alive  #Workers are reused
+assert np.abs(I0-I1).max()<1e-12 and np.abs(I0-I2).max()<1e-12
+
+#%% user-006 Shared-memory transport of the Liouvillian to the workers
+reset_defaults()
+U0=build_L(q=2).U(Dt=1e-4,calc_now=True).U
+sl.Defaults['parallel'],sl.Defaults['ncores']=True,2
+L=build_L(q=2)
+U1=L.U(Dt=1e-4,calc_now=True).U
+assert 'Ln' in L._PropCache._smL   #Workers only received references to shared memory
+assert np.abs(U0-U1).max()<1e-12
+
+#%% user-007 Parallel propagators with orientation-specific relaxation
+reset_defaults()
+I0=R1p(build_L(q=2,OS=True))
+sl.Defaults['parallel'],sl.Defaults['ncores']=True,2
+I1=R1p(build_L(q=2,OS=True))
+sl.Defaults['cache_bytes']=2**14   #Relaxation matrices sent in chunks of the powder average
+I2=R1p(build_L(q=2,OS=True))
+assert np.abs(I0-I1).max()<1e-12 and np.abs(I0-I2).max()<1e-12
+
+#%% user-008 Krylov propagation (no propagators formed)
+reset_defaults()
+I=[]
+for krylov in [False,True]:
+    sl.Defaults['krylov']=krylov
+    L=build_L()
+    seq=L.Sequence(Dt=L.taur/3).add_channel('13C',v1=15000)
+    rho=sl.Rho('13Cx','13Cx')
+    rho.DetProp(seq,n=120)
+    for _ in range(5):seq*rho()   #Rotor phase continues correctly after DetProp
+    I.append(rho.I[0])
+assert np.abs(I[0]-I[1]).max()<1e-10
+
+#%% user-009 Sparse Liouvillian
+reset_defaults()
+I0=R1p(build_L(exchange=True))
+sl.Defaults['sparse']=True
+I1=R1p(build_L(exchange=True))
+sl.Defaults['krylov']=True
+I2=R1p(build_L(exchange=True),n=20)
+assert np.abs(I0-I1).max()<1e-12 and np.abs(I0[:20]-I2).max()<1e-10
+sl.Defaults['krylov'],sl.Defaults['parallel'],sl.Defaults['ncores']=False,True,2
+L=build_L(exchange=True)
+I3=R1p(L)   #Sparse runs serially
+assert not(any(L0._PropCache._smL for L0 in [L,*L._blocks.values()])) and np.abs(I0-I3).max()<1e-12
+
+#%% user-010 Superoperators (Kronecker identities)
+reset_defaults()
+H=np.random.randn(4,4)+1j*np.random.randn(4,4)
+rho=np.random.randn(4,4)+1j*np.random.randn(4,4)
+eye=np.eye(4)
+assert np.abs(sl.Tools.LeftSuper(H)-np.kron(H,eye)).max()<1e-14
+assert np.abs(sl.Tools.RightSuper(H)-np.kron(eye,H.T)).max()<1e-14
+assert np.abs(sl.Tools.Ham2Super(H)-(np.kron(H,eye)-np.kron(eye,H.T))).max()<1e-14
+assert np.abs(sl.Tools.Ham2Super(H,sparse=True).toarray()-sl.Tools.Ham2Super(H)).max()<1e-14
+S=sl.Tools.Ham2Super(H,factored=True)
+assert np.abs(S@rho.reshape(-1)-(H@rho-rho@H).reshape(-1)).max()<1e-12
+
+#%% user-011 Step Liouvillians from the component tensor
+reset_defaults()
+L=build_L()
+L0=L[1]
+for step in [0,3,7]:
+    ph=np.exp(1j*2*np.pi*step/L.expsys.n_gamma)
+    Lstep=np.sum([L0.Ln(m)*ph**(-m) for m in range(-2,3)],axis=0)+L0.Lrf
+    assert np.abs(L0.L(step)-Lstep).max()<1e-8
+
+#%% user-012 Stored Hamiltonian components, bounded by the memory budget
+reset_defaults()
+L=build_L()
+Ln0=np.array([L[1].Ln(m) for m in range(-2,3)])
+assert 1 in L._Ln_H
+L.clear_cache()
+sl.Defaults['cache_bytes']=100   #Too small: components are not stored
+assert np.abs(np.array([L[1].Ln(m) for m in range(-2,3)])-Ln0).max()==0
+assert 1 not in L._Ln_H
+
+#%% user-013 Updating rates in place (set_rate) vs. a new Liouvillian
+reset_defaults()
+L=build_ex()
+for kSD in np.random.uniform(0,100,200):
+    L.set_rate(1,kSD)
+I0=R1p(L)
+L.set_rate(1,42.)
+I1=R1p(L)
+L2=build_ex(kSD=42.)
+assert np.abs(L.Lrelax-L2.Lrelax).max()<1e-12*np.abs(L2.Lrelax).max()
+assert np.abs(I1-R1p(L2)).max()<1e-12
+L.set_rate(0,0)   #k=0 switches T2 off
+L2=build_L(exchange=True).clear_relax()
+L2.add_relax('SpinDiffusion',i=1,k=42.)
+assert np.abs(L.Lrelax-L2.Lrelax).max()<1e-12*np.abs(L2.Lrelax).max()
+assert np.abs(R1p(L)-R1p(L2)).max()<1e-12
+L.set_rate(0,100)   #And back on
+assert np.abs(L.Lrelax-build_ex(kSD=42.).Lrelax).max()<1e-12*np.abs(L2.Lrelax).max()
+L=build_L()
+L.add_SpinEx([0,1],tc=1e-5)
+L.set_rate(1,0)
+assert np.abs(L.Lrelax-build_L().Lrelax).max()==0
+
+#%% user-014 Parameter sweep (one file per grid point) vs. direct calculation
+reset_defaults()
+def update(L,kSD,v1):
+    L.set_rate(1,kSD)
+def recipe(L,kSD,v1):
+    return R1p(L,v1=v1,n=50).real
+with tempfile.TemporaryDirectory() as folder:
+    sweep=sl.Sweep(None,grid={'kSD':[1,10],'v1':[5000,20000]},recipe=recipe,setup=lambda ex:build_ex(),
+                   update=update,folder=folder,filename=lambda index,kSD,v1:f'kSD{index[0]}_v1{index[1]}.npy',nprocs=1)
+    sweep.run(verbose=False)
+    assert np.all(sweep.done) and len(os.listdir(folder))==4
+    L=build_ex()
+    for i in range(len(sweep)):
+        point=sweep.point(i)
+        update(L,**point)
+        assert np.abs(sweep.results[sweep.index(i)]-recipe(L,**point)).max()<1e-12
+
+#%% user-015 Memory-mapped result store for sweeps
+reset_defaults()
+def update(L,kSD,v1):
+    L.set_rate(1,kSD)
+def recipe(L,kSD,v1):
+    return R1p(L,v1=v1,n=50).real
+with tempfile.TemporaryDirectory() as folder:
+    sweep=sl.Sweep(None,grid={'kSD':[1,10],'v1':[5000,20000]},recipe=recipe,
+                   setup=lambda ex:build_ex(),update=update,folder=os.path.join(folder,'sweep'),nprocs=1)
+    sweep.run(verbose=False)
+    assert np.all(sweep.done) and sweep.results.shape==(2,2,50)
+    L=build_ex()
+    for i in range(len(sweep)):
+        point=sweep.point(i)
+        update(L,**point)
+        assert np.abs(sweep.results[sweep.index(i)]-recipe(L,**point)).max()<1e-12
+    store=sl.ResultStore(os.path.join(folder,'sweep'))   #Reopen the stored results
+    assert np.all(store.done) and np.abs(store.data-sweep.results).max()==0
+    I=np.array(store.data)
+    del sweep,store
+    #Results of an older run (one file per kSD) are imported, failed points (None) are not stored
+    for q in range(2):np.save(os.path.join(folder,f'kSD{q}.npy'),I[q])
+    legacy=lambda index,kSD,v1:np.load(os.path.join(folder,f'kSD{index[0]}.npy'))[index[1]] if index!=(1,1) else None
+    sweep=sl.Sweep(None,grid={'kSD':[1,10],'v1':[5000,20000]},recipe=lambda L,kSD,v1:None,
+                   setup=lambda ex:build_ex(),update=update,folder=os.path.join(folder,'sweep1'),legacy=legacy,nprocs=1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        sweep.run(verbose=False)
+    assert sweep.done.sum()==3 and not(sweep.done[1,1]) and np.abs(sweep.results[0]-I[0]).max()==0
+    del sweep
+
+#%% user-016 Grid fit vs. explicit residuals
+import sys
+sys.path.append(os.path.join(os.path.dirname(sl.__file__),'..'))
+from grid_fit import GridFit,ContinuousFit
+reset_defaults()
+tc0,kSD0=np.logspace(-6,-4,5),np.array([0,10,30,100])
+def simulate(tc,kSD):   #Stand-in for the spin-lock simulations (nv1,nt)
+    t=np.arange(100)*1e-4
+    return np.array([np.exp(-t*(1e6*tc/(1+(v1*tc)**2)+kSD)) for v1 in [1e4,3e4]])
+I=np.array([[simulate(tc,kSD) for kSD in kSD0] for tc in tc0])
+iexp=np.arange(0,100,5)
+Iexp=2*simulate(tc0[2],kSD0[1])[:,iexp]
+fit=GridFit(I,Iexp,iexp)
+assert fit.fixed_kSD()==(2,1) and np.abs(fit.scale[2,1]-2).max()<1e-12
+error=[]
+for k,Ie in enumerate(Iexp):   #Experiment scaled onto the simulation
+    I0=I[:,:,k,iexp]
+    scale=(I0*Ie).sum(-1)/(Ie*Ie).sum(-1)
+    error.append(((Ie-I0/scale[...,None])**2).sum(-1))
+assert np.abs(GridFit(I,Iexp,iexp,scale='exp').total_error()-np.sum(error,axis=0)).max()<1e-12
+
+#%% user-017 Continuous fit (run the user-016 cell first)
+reset_defaults()
+cfit=ContinuousFit(simulate,2*simulate(3e-5,20)[:,iexp],iexp,I=I,tc0=tc0,kSD0=kSD0)
+tc,kSD=cfit.optimize(maxfev=100,xatol=1e-5)
+assert abs(np.log10(tc/3e-5))<1e-2 and abs(kSD-20)<1
+
+#%% user-018 Stored eigendecomposition, several Rho objects in one DetProp
+reset_defaults()
+L=build_L(exchange=True)
+U=L.Sequence().add_channel('13C',v1=20000).U()
+U.eig()
+for (d,v,vi),U0 in zip(U._eig,U.U):
+    assert np.abs(v@np.diag(d)@vi-U0).max()<1e-10
+rho=[sl.Rho(rho0,'13Cx') for rho0 in ['13Cx','13Cz']]
+rho[0].DetProp(U,n=150,others=rho[1:])
+for rho0,rho1 in zip(['13Cx','13Cz'],rho):
+    assert np.abs(sl.Rho(rho0,'13Cx').DetProp(U,n=150).I-rho1.I).max()<1e-12
+
+#%% user-019 Batched eigendecomposition and powers of propagators
+reset_defaults()
+L=build_L(exchange=True)
+U=L.Sequence().add_channel('13C',v1=20000).U()
+U5=U**5
+U1=U*U*U*U*U
+assert np.abs(U5.U-U1.U).max()<1e-10
+v=np.random.randn(3,5,5)
+v[1,:,0]=v[1,:,1]   #Singular: pseudo-inverse
+vi=sl.Tools.inv_batch(v)
+assert np.abs(vi[0]-np.linalg.inv(v[0])).max()<1e-10 and np.abs(vi[1]-np.linalg.pinv(v[1])).max()<1e-10
+
+#%% user-020 Stacked propagators and density matrices
+reset_defaults()
+L=build_L(q=2)
+U=L.Sequence().add_channel('13C',v1=20000).U()
+rho=sl.Rho('13Cx','13Cx')
+U*rho
+assert isinstance(U.U,np.ndarray) and U.U.shape==(len(L),*U.shape)
+assert rho._rho.shape==(len(L),U.shape[0])
+
+#%% user-021 Eigenbasis detection vs. step-by-step propagation
+reset_defaults()
+L=build_L(exchange=True)
+U=L.Sequence().add_channel('13C',v1=20000).U()
+rho0=sl.Rho('13Cx',['13Cx','13Cy'])
+rho0.DetProp(U,n=150)   #Eigenbasis, signal only
+rho1=sl.Rho('13Cx',['13Cx','13Cy'])
+for _ in range(150):U*rho1()
+assert rho0.I.shape==rho1.I.shape==(2,150)
+assert np.abs(rho0.I-rho1.I).max()<1e-10 and np.abs(rho0.t_axis-rho1.t_axis).max()<1e-12
+assert np.abs(rho0._rho-rho1._rho).max()<1e-10
+
+#%% user-022 Preallocated signal buffers (grown during detection)
+reset_defaults()
+L=build_L(exchange=True)
+U=L.Sequence().add_channel('13C',v1=20000).U()
+rho0=sl.Rho('13Cx',['13Cx','13Cy'])
+rho0.DetProp(U,n=100)
+for _ in range(200):U*rho0()
+rho1=sl.Rho('13Cx',['13Cx','13Cy'])
+for _ in range(300):U*rho1()
+assert rho0.I.shape==rho1.I.shape==(2,300) and rho0.Ipwd.shape==(len(L),2,300)
+assert np.abs(rho0.I-rho1.I).max()<1e-10 and np.abs(rho0.t_axis-rho1.t_axis).max()<1e-12
+
+#%% user-023 Powder-averaged signal and cached spectra
+reset_defaults()
+L=build_L(q=2)
+U=L.Sequence().add_channel('13C',v1=20000).U()
+rho=sl.Rho('13Cx','13Cx')
+rho.DetProp(U,n=64)
+assert np.abs(rho.I-(rho.Ipwd*L.pwdavg.weight[:,None,None]).sum(0)).max()<1e-12
+S0=rho.FT
+assert rho.FT is S0   #Cached
+rho.DetProp(U,n=64)   #Spectrum is updated after further propagation
+rho1=sl.Rho('13Cx','13Cx')
+rho1.DetProp(U,n=128)
+assert rho.FT is not S0 and np.abs(rho.FT-rho1.FT).max()<1e-10*np.abs(rho1.FT).max()
+
+#%% user-025 Cached state-space reduction
+reset_defaults()
+L=build_ex()
+I0=R1p(L)
+assert len(L._block_structure)
+I1=R1p(L)   #Reduction reused
+L.set_rate(1,0)   #Switching a term off may change the reduction
+I2=R1p(L)
+L2=build_ex(kSD=0)
+assert np.abs(I0-I1).max()<1e-12 and np.abs(I2-R1p(L2)).max()<1e-12
+sl.Defaults['cache_bytes']=2**17
+for v1 in [5000,10000,20000,30000]:R1p(L,v1=v1)
+assert all(L0._PropCache in sl.Propagator._caches for L0 in L._blocks.values())
+assert sum(PC.nbytes for PC in sl.Propagator._caches)<=2**17  #Block caches count against the shared budget
+
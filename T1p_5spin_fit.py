@@ -9,6 +9,8 @@ Created on Tue Jul  9 10:14:05 2024
 import os
 import numpy as np
 import matplotlib.pyplot as plt
+import SLEEPY as sl
+from grid_fit import GridFit
 
 
 #%% Load all data from folders 
@@ -23,11 +25,19 @@ while os.path.exists(folder):
     tc0=np.load(os.path.join(folder,'tc.npy'),allow_pickle=False)
     kSD0=np.load(os.path.join(folder,'kSD.npy'),allow_pickle=False)
     
-    for file in sorted(os.listdir(folder)):
-        if file[:2]=='tc' and file[6:9]=='kSD':
-            tc.append(tc0[int(file[2:5])])
-            kSD.append(kSD0[int(file[9:11])])
-            I.append(np.load(os.path.join(folder,file),allow_pickle=False))
+    #Results from sl.Sweep (single memory-mapped file (ntc,nSD,nv1,nt)) are merged with older runs (one file per (tc,kSD))
+    store=sl.ResultStore(folder) if sl.ResultStore.exists(folder) else None
+    for p in range(tc0.size):
+        for q in range(kSD0.size):
+            file=os.path.join(folder,f'tc{p:03d}_kSD{q:02d}.npy')
+            if store is not None and np.all(store.done[p,q]):   #All spin-lock strengths calculated
+                I.append(np.array(store.data[p,q]))
+            elif os.path.exists(file):
+                I.append(np.load(file,allow_pickle=False))
+            else:
+                continue
+            tc.append(tc0[p])
+            kSD.append(kSD0[q])
     k+=1
     folder=f'T1p_5spin_run{k}'
     
@@ -67,18 +77,8 @@ tsim=np.arange(500)*.0002
 iexp=np.array([np.argmin(np.abs(tsim-t)) for t in texp]) #Index for comparing simulation to experiment
 
 skip=0
-error=[]
-for k,Ie in enumerate(Iexp):
-    I0=I[:,k,iexp].reshape([nsims,nexp])
-    # I0[I0==0]=1e-3
-    scale=((Ie[skip:]*Ie[skip:]).sum(-1))**(-1)*(I0[:,skip:]*Ie[skip:]).sum(-1)
-    # scale=I0[:,skip]/Ie[skip]
-    
-    # scale=(Ie/I0).mean(1)
-    error.append(((Ie-(I0.T/scale).T)**2).sum(1))
-error=np.array(error).sum(0)
-
-error[np.isnan(error)]=error[np.logical_not(np.isnan(error))].max()
+fit=GridFit(I,Iexp,iexp,skip=skip,scale='exp')  #Experiment scaled onto each simulated curve
+error=fit.total_error()
 
     
 
@@ -102,10 +102,7 @@ def exp_v_sim(i:int=None,ax:list=None):
     for k,a in enumerate(ax[:-1]):
         a.plot(tsim*1e3,I[i,k],color='red')
         
-        scale=((Iexp[k,skip:]*Iexp[k,skip:]).sum())**(-1)*(I[i,k,iexp[skip:]]*Iexp[k,skip:]).sum()
-        # scale=I[i,k,skip]/Iexp[k,skip]
-        
-        a.scatter(texp*1e3,Iexp[k]*scale,marker='o',color='black')
+        a.scatter(texp*1e3,Iexp[k]/fit.scale[i,k],marker='o',color='black')
         a.set_ylim([0,1])
         a.set_xlabel('t / ms')
         
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Spin system (13C with the 1H of two water molecules) and the functions used
+to simulate it (setup, update, recipe), along with the grid of the sweep
+stored in T1p_5spin_run0. Importing this module does not modify Defaults or
+create any files, so that it may be used by both TwoWaterSwp.py and the
+fitting scripts (fit_5spin.py).
+"""
+
+import numpy as np
+import SLEEPY as sl
+
+from NMRparameters import deltaCSA,etaCSA,alphaCSA,betaCSA,gammaCSA   #13C CSA
+from NMRparameters import delta,beta,gamma                      #H-C dipole
+from NMRparameters import deltaHCSA,alphaHCSA,betaHCSA,gammaHCSA,HCS  #1H CS/CSA
+from NMRparameters import deltaHH,betaHH,gammaHH              #H–H dipole
+
+#%% Build 5-spin simulations
+ex=sl.ExpSys(v0H=400,Nucs=['13C','1H','1H','1H','1H'],vr=5000,pwdavg=sl.PowderAvg(q=2))
+ex.set_inter('CSA',i=0,delta=deltaCSA,eta=etaCSA,euler=[alphaCSA,betaCSA,gammaCSA])
+for k in range(4):
+    ex.set_inter('dipole',i0=0,i1=k+1,delta=delta[k],euler=[0,beta[k],gamma[k]])
+    ex.set_inter('CSA',i=k+1,delta=deltaHCSA[k],euler=[alphaHCSA[k],betaHCSA[k],gammaHCSA[k]])
+    ex.set_inter('CS',i=k+1,ppm=HCS[k])
+    for m in range(k+1,4):
+        ex.set_inter('dipole',i0=k+1,i1=m+1,delta=deltaHH[k,m],euler=[0,betaHH[k,m],gammaHH[k,m]])
+
+
+#%% Grid of the sweep
+ntc=81
+nSD=12
+
+tc0=np.logspace(-6,-2,ntc)
+kSD0=np.concatenate([[0],np.logspace(0,2,nSD-1)])
+
+nt=500
+v10=[2000,7000,12000,14000,22000]
+
+#%% Simulation functions (see sl.Sweep)
+def setup(ex):
+    L=ex.Liouvillian()  #Built once; only the rates are updated for each point
+    L.add_SpinEx([1,2], tc0[0])
+    L.add_SpinEx([3,4], tc0[0])
+    for i in range(1,5):
+        L.add_relax(Type='SpinDiffusion',i=i,k=kSD0[0])
+    return L
+
+def update(L,tc,kSD,v1):
+    L.set_rate(0,1/tc).set_rate(1,1/tc)
+    for i in range(2,6):
+        L.set_rate(i,kSD)
+
+def recipe(L,tc,kSD,v1):
+    try:
+        seq=L.Sequence().add_channel('13C',v1=v1)
+
+        rho=sl.Rho(rho0='13Cx',detect='13Cx')
+        rho.DetProp(seq,n=nt)
+        return rho.I[0].real
+    except Exception as e:
+        print(tc,kSD,v1,e)
+        return None   #Not stored by the sweep (attempted again by the next run)
@@ -8,6 +8,8 @@ Created on Tue Nov 12 15:09:59 2024
 
 import numpy as np
 import matplotlib.pyplot as plt
+import os
+import SLEEPY as sl
 
 #%% Load experiments
 nexp=11
@@ -28,11 +30,16 @@ nSD=11
 tc0=np.logspace(-6,-3,ntc)
 kSD0=np.logspace(0,2,nSD)
 
-I=np.zeros([tc0.size,kSD0.size,5,nt])
+#Results from sl.Sweep (single memory-mapped file (ntc,nSD,nv1,nt)) are merged with older runs (one file per (tc,kSD))
+store=sl.ResultStore('T1p_3spin_run0') if sl.ResultStore.exists('T1p_3spin_run0') else None
+I=np.full([tc0.size,kSD0.size,5,nt],np.nan)   #Missing simulations are nan
 for p,tc in enumerate(tc0):
     for q,kSD in enumerate(kSD0):
         file=f'T1p_3spin_run0/R1p_{-np.log10(tc):.1f}_{np.log10(kSD):.1f}'.replace('.','p')+'.npy'
-        I[p,q]=np.load(file,allow_pickle=False)
+        if store is not None and np.all(store.done[p,q]):   #All spin-lock strengths calculated
+            I[p,q]=store.data[p,q]
+        elif os.path.exists(file):
+            I[p,q]=np.load(file,allow_pickle=False)
 
 
 #%% Which time points match experimental time points?
@@ -50,7 +57,7 @@ for k,Ie in enumerate(Iexp):
     error.append(((Ie[skip:]-(scale*I0.T).T)**2).sum(1))
 error=np.array(error).sum(0)
 
-i=np.argmin(error)
+i=np.nanargmin(error)   #Missing simulations (nan) are skipped
 
 iSD=np.mod(i,nSD)
 kSDf=kSD0[iSD]
@@ -11,6 +11,7 @@ import SLEEPY as sl
 import os
 import matplotlib.pyplot as plt
 import warnings
+from grid_fit import GridFit,ContinuousFit
 
 warnings.filterwarnings("ignore", message="invalid value encountered in true_divide")
 
@@ -49,16 +50,21 @@ skip=0
 tsim=np.arange(500)*.0002
 iexp=np.array([np.argmin(np.abs(tsim-t)) for t in texp]) #Index for comparing simulation to experiment
 
-for file in sorted(os.listdir(folder)):
-    if file[:2]=='tc' and file[6:9]=='kSD':
-        I.append([])
-        tc.append(tc0[int(file[2:5])])
-        kSD.append(kSD0[int(file[9:11])])
-        I0=np.load(os.path.join(folder,file),allow_pickle=False)
-        for k in range(5):
-            scale=((Iexp[k,skip:]*Iexp[k,skip:]).sum())**(-1)*(I0[k,iexp[skip:]]*Iexp[k,skip:]).sum()
-        
-            I[-1].append(I0[k]/scale)
+#Results from sl.Sweep (single memory-mapped file (ntc,nSD,nv1,nt)) are merged with older runs (one file per (tc,kSD))
+store=sl.ResultStore(folder) if sl.ResultStore.exists(folder) else None
+for p in range(tc0.size):
+    for q in range(kSD0.size):
+        file=os.path.join(folder,f'tc{p:03d}_kSD{q:02d}.npy')
+        if store is not None and np.all(store.done[p,q]):   #All spin-lock strengths calculated
+            I0=np.array(store.data[p,q])
+        elif os.path.exists(file):
+            I0=np.load(file,allow_pickle=False)
+        else:
+            continue
+        tc.append(tc0[p])
+        kSD.append(kSD0[q])
+        scale=((Iexp[:,skip:]*Iexp[:,skip:]).sum(-1))**(-1)*(I0[:,iexp[skip:]]*Iexp[:,skip:]).sum(-1)
+        I.append(I0/scale[:,None])
     
 kSD=np.array(kSD)
 tc=np.array(tc)
@@ -70,6 +76,14 @@ sim_data={'t':np.arange(500)*.0002,'tc':tc,'kSD':kSD,'I':I}
 
 nsims=len(kSD)
 
+#Simulations on the full (ntc,nSD) grid for fitting (missing simulations are nan)
+itc_sim=np.argmin(np.abs(tc0[:,None]-tc),axis=0)
+iSD_sim=np.argmin(np.abs(kSD0[:,None]-kSD),axis=0)
+Igrid=np.full([tc0.size,kSD0.size,*I.shape[1:]],np.nan)
+Igrid[itc_sim,iSD_sim]=I
+
+fit=GridFit(Igrid,Iexp,iexp,scale=False)  #Simulations are already scaled to the experiment above
+
 
 
 
@@ -77,7 +91,7 @@ nsims=len(kSD)
 v1=[2,7,12,14,22]
 
 
-def get_tc_kSD(tc=None,kSD=None):
+def sim_index(tc=None,kSD=None):
     if kSD is not None:
         kSD=sim_data['kSD'][np.argmin(np.abs(kSD-sim_data['kSD']))]
         i0=kSD==sim_data['kSD']
@@ -89,26 +103,14 @@ def get_tc_kSD(tc=None,kSD=None):
         i1=tc==sim_data['tc']
     else:
         i1=np.ones(sim_data['tc'].size,dtype=bool)
-    i0=np.logical_and(i0,i1)
-    
+    return np.logical_and(i0,i1)
+
+def get_tc_kSD(tc=None,kSD=None):
+    i0=sim_index(tc=tc,kSD=kSD)
     return {key:value[i0] if len(value)==len(sim_data['tc']) else value for key,value in sim_data.items()}
     
 def get_error(skip:int=0,q=None,kSD=None,tc=None):
-    
-    sim_data=get_tc_kSD(tc=tc,kSD=kSD)
-    nsims=len(sim_data['tc'])
-    
-    error=[]
-    q=np.arange(5) if q is None else np.atleast_1d(q)
-    for k,Ie in enumerate(Iexp):
-        if k not in q:continue
-        I0=sim_data['I'][:,k,iexp].reshape([nsims,nexp])
-        error.append(((Ie-I0)**2).sum(1))
-    error=np.array(error).sum(0)
-    
-    error[np.isnan(error)]=error[np.logical_not(np.isnan(error))].max()
-
-    return error
+    return fit.total_error(q)[itc_sim,iSD_sim][sim_index(tc=tc,kSD=kSD)]
 
 def plot_fixed_kSD(i:int=None,ax:list=None,skip:int=0,kSD:float=None,tc:float=None,q=None):
 
@@ -155,23 +157,7 @@ def plot_fixed_kSD(i:int=None,ax:list=None,skip:int=0,kSD:float=None,tc:float=No
     
     
 def plot_variable_kSD():
-    best=[]
-    error=[]
-    tc0=get_tc_kSD(kSD=0)['tc']
-    kSD0=get_tc_kSD(tc=1000)['kSD']
-    for tc in tc0:
-        error.append(0)
-        best.append([])
-        for q in range(5):
-            e=get_error(tc=tc,q=q)
-            best[-1].append(np.argmin(e))
-            error[-1]+=e[best[-1][-1]]
-    
-    error=np.array(error)
-    best=np.array(best)        
-    
-    i=np.argmin(error)
-    best=best[i]
+    i,best=fit.variable_kSD()
     
     tc=tc0[i]
     # fig=plt.figure()
@@ -179,22 +165,42 @@ def plot_variable_kSD():
     fig,ax=plt.subplots(2,3,sharex=False)
     ax=ax.flatten()
     
-    sim_data=get_tc_kSD(tc=tc)
     v1=[2,7,12,14,22]
     for k,a in enumerate(ax[:-1]):
         sc=exp_data['I0'][k].max()
-        a.plot(sim_data['t']*1e3,sim_data['I'][best[k]][k]/sc,color='red')
+        a.plot(sim_data['t']*1e3,Igrid[i,best[k],k]/sc,color='red')
         a.scatter(exp_data['t']*1e3,exp_data['I0'][k]/sc,color='black',marker='o')
         a.set_ylim([0,1.05])
         if not(a.is_last_row()):a.set_xticklabels([])
         if not(a.is_first_col()):a.set_yticklabels([])
         if a.is_last_row():a.set_xlabel('t / ms')
         a.text(25,.8,f'{v1[k]} kHz'+'\n'+fr'$k_{{SD}}$ = {kSD0[best[k]]:.1f} s$^{{-1}}$',verticalalignment='top')
-        ax[-1].plot(sim_data['t']*1e3,sim_data['I'][best[k]][k])
+        ax[-1].plot(sim_data['t']*1e3,Igrid[i,best[k],k])
     ax[-1].legend([f'{v10} kHz' for v10 in v1])
     ax[-1].set_xlabel('t / ms')
         
     ax[1].set_title(fr'$\tau_c$ = {tc*1e6:.1f} $\mu$s')
     fig.set_size_inches([8,5])
     fig.tight_layout()
-    return fig
\ No newline at end of file
+    return fig
+
+
+#%% Continuous refinement between grid points (simulates on demand)
+def refine_fit(maxfev:int=40):
+    """
+    Refines the fixed-kSD fit beyond the grid, starting from the cubic
+    interpolation of the grid and running tens of new simulations. Returns
+    (tc,kSD)
+    """
+    import TwoWaterSys as tw   #Spin system, Liouvillian setup, and spin-lock recipe of the sweep
+    L=tw.setup(tw.ex)
+    def simulate(tc,kSD):
+        tw.update(L,tc,kSD,None)
+        I=[tw.recipe(L,tc,kSD,v1) for v1 in tw.v10]
+        assert all(I0 is not None for I0 in I),f'Simulation failed for tc={tc}, kSD={kSD}'
+        return np.array(I)
+    
+    global cfit
+    cfit=ContinuousFit(simulate,Iexp,iexp,I=Igrid,tc0=tc0,kSD0=kSD0)
+    return cfit.optimize(maxfev=maxfev)
+
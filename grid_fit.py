@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fitting of experimental R1p decays to the full grid of simulations,
+(ntc,nSD,nv1,nt), as produced by OneWaterSwp.py and TwoWaterSwp.py. All
+scale factors and residuals are calculated in one pass over the grid, so that
+refitting (different spin-lock strengths, fixed or variable kSD) only
+requires selecting from the stored residuals.
+
+ContinuousFit refines the fit between grid points, running simulations only
+where the optimizer needs them.
+"""
+
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+from scipy.optimize import minimize
+
+
+class GridFit():
+    def __init__(self,I,Iexp,iexp,skip:int=0,scale=True):
+        """
+        Calculates the residuals between experimental decays and all
+        simulations in a grid.
+
+        fit=GridFit(I,Iexp,iexp)
+        itc,iSD=fit.fixed_kSD()       #Best tc and kSD, common to all spin-lock strengths
+        itc,iSD=fit.variable_kSD()    #Best tc, with kSD fitted for each spin-lock strength
+
+        Parameters
+        ----------
+        I : np.array
+            Simulated decays with shape (ntc,nSD,nv1,nt). Other leading
+            dimensions are possible, i.e. (...,nv1,nt), although fixed_kSD and
+            variable_kSD require the (ntc,nSD) grid. Missing simulations
+            should be set to nan.
+        Iexp : np.array
+            Experimental decays (nv1,nexp).
+        iexp : np.array
+            Index of the simulated time points matching the experimental
+            time points (nexp).
+        skip : int, optional
+            Number of initial experimental points to skip. The default is 0.
+        scale : bool or str, optional
+            Scale each simulated curve by its least-squares optimal factor
+            before calculating the residual. Set to 'exp' to instead scale 
+            the experimental curve onto the simulation (factor 
+            sum(I0*Ie)/sum(Ie**2), as used previously in T1p_5spin_fit.py), 
+            in which case the residual is calculated for the simulation 
+            divided by this factor. Set to False if the simulations are 
+            already scaled. The default is True.
+
+        Returns
+        -------
+        None.
+
+        """
+        I0=np.asarray(I)[...,np.asarray(iexp)[skip:]]
+        Ie=np.asarray(Iexp)[:,skip:]
+
+        if isinstance(scale,str):
+            assert scale=='exp',"scale must be True, False, or 'exp'"
+            with np.errstate(invalid='ignore',divide='ignore'):
+                self.scale=(Ie*Ie).sum(-1)/(I0*Ie).sum(-1)
+        elif scale:
+            with np.errstate(invalid='ignore',divide='ignore'):
+                self.scale=(I0*Ie).sum(-1)/(I0*I0).sum(-1)
+        else:
+            self.scale=np.ones(I0.shape[:-1])
+
+        with np.errstate(invalid='ignore'):
+            error=((Ie-self.scale[...,None]*I0)**2).sum(-1)
+        nan=np.isnan(error)
+        assert not(np.all(nan)),"No valid simulations (all residuals are nan)"
+        if np.any(nan):error[nan]=error[np.logical_not(nan)].max()   #Missing/failed simulations never fit best
+        self.error=error  #Residual for each simulation and spin-lock strength (...,nv1)
+
+    def _q(self,q):
+        return np.arange(self.error.shape[-1]) if q is None else np.atleast_1d(q)
+
+    def total_error(self,q=None):
+        """
+        Residual summed over the selected spin-lock strengths
+
+        Parameters
+        ----------
+        q : int or list, optional
+            Index of spin-lock strengths to include. The default is None (all)
+
+        Returns
+        -------
+        np.array
+            Shape of the grid (...).
+
+        """
+        return self.error[...,self._q(q)].sum(-1)
+
+    @property
+    def best_per_v1(self):
+        """
+        Index of the best simulation (tc and kSD) for each spin-lock strength
+        separately, with shape (nv1,2) for an (ntc,nSD) grid
+        """
+        shape=self.error.shape[:-1]
+        i=np.argmin(self.error.reshape([-1,self.error.shape[-1]]),axis=0)
+        return np.array(np.unravel_index(i,shape)).T
+
+    def fixed_kSD(self,q=None,itc=None,iSD=None):
+        """
+        Best fit where tc and kSD are the same for all spin-lock strengths.
+        Optionally, tc or kSD may be fixed to a given index.
+
+        Parameters
+        ----------
+        q : int or list, optional
+            Index of spin-lock strengths to include. The default is None (all)
+        itc : int, optional
+            Fix tc to this index. The default is None.
+        iSD : int, optional
+            Fix kSD to this index. The default is None.
+
+        Returns
+        -------
+        tuple
+            (itc,iSD)
+
+        """
+        error=self.total_error(q)
+        assert error.ndim==2,"fixed_kSD requires a (ntc,nSD) grid of simulations"
+        mask=np.zeros(error.shape,dtype=bool)
+        mask[slice(None) if itc is None else itc,slice(None) if iSD is None else iSD]=True
+        error=np.where(mask,error,np.inf)
+        return np.unravel_index(np.argmin(error),error.shape)
+
+    def variable_kSD(self,q=None):
+        """
+        Best fit where tc is the same for all spin-lock strengths, but kSD
+        is fitted separately for each spin-lock strength.
+
+        Parameters
+        ----------
+        q : int or list, optional
+            Index of spin-lock strengths to include. The default is None (all)
+
+        Returns
+        -------
+        tuple
+            (itc,iSD), where iSD has one entry per spin-lock strength in q
+
+        """
+        assert self.error.ndim==3,"variable_kSD requires a (ntc,nSD) grid of simulations"
+        error=self.error[...,self._q(q)]    #(ntc,nSD,nq)
+        iSD=np.argmin(error,axis=1)         #Best kSD for each tc and spin-lock strength
+        itc=np.argmin(np.take_along_axis(error,iSD[:,None],axis=1)[:,0].sum(-1))
+        return itc,iSD[itc]
+
+
+#%% Continuous refinement
+class ContinuousFit():
+    def __init__(self,simulate,Iexp,iexp,I=None,tc0=None,kSD0=None,skip:int=0):
+        """
+        Fits tc and kSD continuously (not restricted to a grid), where the
+        objective is evaluated by running the simulation, e.g. Liouvillian 
+        with updated rates (L.set_rate) followed by spin-lock DetProp for 
+        each spin-lock strength. Simulations are stored, so that no point is 
+        simulated twice. Note that propagators are not shared between 
+        evaluations, since updating the rates (set_rate) discards the stored
+        propagators.
+        
+        If the grid of simulations is provided (I,tc0,kSD0), the optimization
+        starts from the best grid point, and is first carried out on a cubic
+        interpolation of the grid (surrogate, requires at least 4 values of 
+        tc and kSD), such that only the final refinement requires new 
+        simulations.
+        
+        The optimization is carried out in log10(tc) and log10(1+kSD)
+        
+        L=setup(ex)
+        def simulate(tc,kSD):
+            L.set_rate(0,1/tc).set_rate(1,kSD)
+            return np.array([recipe(L,tc,kSD,v1) for v1 in v10])
+        cfit=ContinuousFit(simulate,Iexp,iexp,I=I,tc0=tc0,kSD0=kSD0)
+        tc,kSD=cfit.optimize()
+
+        Parameters
+        ----------
+        simulate : function
+            Called as simulate(tc,kSD), returning the simulated decays for
+            all spin-lock strengths (nv1,nt).
+        Iexp : np.array
+            Experimental decays (nv1,nexp).
+        iexp : np.array
+            Index of the simulated time points matching the experimental
+            time points (nexp).
+        I : np.array, optional
+            Grid of simulations (ntc,nSD,nv1,nt). The default is None.
+        tc0 : np.array, optional
+            Correlation times of the grid. The default is None.
+        kSD0 : np.array, optional
+            Spin-diffusion rate constants of the grid. The default is None.
+        skip : int, optional
+            Number of initial experimental points to skip. The default is 0.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.simulate=simulate
+        self.Iexp=np.asarray(Iexp)
+        self.iexp=np.asarray(iexp)
+        self.skip=skip
+        self.sims={}    #Stored simulations, keyed by (tc,kSD)
+        
+        self._interp=None
+        self.x0=None
+        if I is not None:
+            assert tc0 is not None and kSD0 is not None,"tc0 and kSD0 must be provided with the grid of simulations"
+            I=np.asarray(I)
+            itc,iSD=GridFit(I,Iexp,iexp,skip=skip).fixed_kSD()
+            self.x0=self.to_x(tc0[itc],kSD0[iSD])
+            
+            I0=I[...,self.iexp]
+            if not(np.any(np.isnan(I0))) and min(len(tc0),len(kSD0))>=4:  #Cubic interpolation requires 4 points
+                self._interp=RegularGridInterpolator((np.log10(tc0),np.log10(1+np.asarray(kSD0))),
+                                                     I0,method='cubic',bounds_error=False,fill_value=None)
+            self.bounds=[(np.log10(tc0).min(),np.log10(tc0).max()),(np.log10(1+np.min(kSD0)),np.log10(1+np.max(kSD0)))]
+        else:
+            self.bounds=None
+    
+    @staticmethod
+    def to_x(tc,kSD):
+        return np.array([np.log10(tc),np.log10(1+kSD)])
+    
+    @staticmethod
+    def from_x(x):
+        return 10**x[0],10**x[1]-1
+    
+    def _error(self,I0):
+        """
+        Residual for decays I0 (nv1,nexp), with least-squares optimal scaling
+        of each curve
+        """
+        I0,Ie=I0[:,self.skip:],self.Iexp[:,self.skip:]
+        scale=(I0*Ie).sum(-1)/(I0*I0).sum(-1)
+        error=((Ie-scale[:,None]*I0)**2).sum()
+        return error if np.isfinite(error) else np.inf
+    
+    def error(self,tc:float,kSD:float):
+        """
+        Residual between experiment and simulation for the given tc and kSD
+        (simulates only if not previously simulated)
+        """
+        key=(float(tc),float(kSD))
+        if key not in self.sims:
+            self.sims[key]=np.asarray(self.simulate(tc,kSD))
+        return self._error(self.sims[key][:,self.iexp])
+    
+    def surrogate(self,tc:float,kSD:float):
+        """
+        Residual for the cubic interpolation of the grid of simulations 
+        """
+        assert self._interp is not None,"Surrogate requires a complete grid of simulations"
+        return self._error(self._interp(self.to_x(tc,kSD))[0])
+    
+    @property
+    def nsims(self):
+        return len(self.sims)
+    
+    def optimize(self,x0=None,surrogate:bool=True,maxfev:int=40,xatol:float=1e-3):
+        """
+        Runs the optimization (Nelder-Mead, in log10(tc),log10(1+kSD)). 
+
+        Parameters
+        ----------
+        x0 : tuple, optional
+            Starting (tc,kSD). The default is None, which uses the best point
+            of the grid.
+        surrogate : bool, optional
+            First optimize on the cubic interpolation of the grid. The 
+            default is True.
+        maxfev : int, optional
+            Maximum number of simulations. The default is 40.
+        xatol : float, optional
+            Convergence criterion (log10 units). The default is 1e-3.
+
+        Returns
+        -------
+        tuple
+            (tc,kSD)
+
+        """
+        x0=self.x0 if x0 is None else self.to_x(*x0)
+        assert x0 is not None,"Provide a starting point (x0) or the grid of simulations"
+        
+        step=np.array([.1,.1]) if self.bounds is None else np.diff(self.bounds,axis=1)[:,0]/20  #Initial simplex size
+        def simplex(x):
+            return np.concatenate([[x],x+np.diag(step)])
+        
+        if surrogate and self._interp is not None:
+            x0=minimize(lambda x:self.surrogate(*self.from_x(x)),x0,method='Nelder-Mead',bounds=self.bounds,
+                        options={'xatol':xatol,'initial_simplex':simplex(x0)}).x
+            step=step/4   #Surrogate optimum is close
+        
+        self.result=minimize(lambda x:self.error(*self.from_x(x)),x0,method='Nelder-Mead',bounds=self.bounds,
+                             options={'xatol':xatol,'fatol':0,'maxfev':maxfev,'initial_simplex':simplex(x0)})
+        return self.from_x(self.result.x)